@@ -1,20 +1,26 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
-from logging.config import dictConfig
 
 from tortoise import Tortoise
-from .logconfig import LOGCONFIG_DICT
+from .logconfig import configure_logging
 
-dictConfig(LOGCONFIG_DICT)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 import os
 import importlib
 import inspect
+import signal
 import config
-from config import TG_BOT_NAME, DATABASE_URI
-from .telegram import client as tg, tg_start, tg_stop
+from time import monotonic
+from config import TG_BOT_NAME, DATABASE_URI, TG_DRAIN_TIMEOUT
+from .telegram import client as tg, tg_start, tg_stop, tg_take_over, tg_release, tg_drain
+from .util import Timer
+
+# background jobs (`task_*` coroutines in bot.<module>.tasks), started after we connect
+tasks = []
+running_tasks = []
 
 async def init_db():
 	# discover modules
@@ -39,6 +45,17 @@ async def init_db():
 			if str(e) != f"No module named '{modname}'":
 				logger.exception(f"Error loading {modname}")
 
+		try:
+			modname = f"bot.{module}.tasks"
+			module_tasks = importlib.import_module('.tasks', package=f'bot.{module}')
+			for funcname, func in inspect.getmembers(module_tasks, inspect.iscoroutinefunction):
+				if funcname.startswith('task_'):
+					logger.info(f'adding bot.{module}.tasks.{funcname}')
+					tasks.append(func)
+		except ModuleNotFoundError as e:
+			if str(e) != f"No module named '{modname}'":
+				logger.exception(f"Error loading {modname}")
+
 		try:
 			modname = f"bot.{module}.models"
 			importlib.import_module('.models', package=f'bot.{module}')
@@ -58,26 +75,78 @@ async def init_db():
 	except Exception:
 		logger.exception("help")
 
+# everything after init_db; see main
 async def startup():
-	await init_db()
+	# only now, so that the old process (if there is one) keeps going while we're getting ready
+	await tg_take_over()
 	await tg_start()
+	for func in tasks:
+		running_tasks.append(asyncio.ensure_future(func()))
 
 async def shutdown():
+	start = monotonic()
+	timeout = TG_DRAIN_TIMEOUT.total_seconds()
+
+	# no new updates from here on, just the ones we've already started on
+	await tg.stop_accepting()
+	drained, cut_off = await tg_drain(timeout)
+
+	# message deletions and such that were due later
+	fired = await Timer.fire_all()
+
+	# tasks flush whatever they've got pending when cancelled, so give them a moment to do that
+	for task in running_tasks:
+		task.cancel()
+	stopped, stuck = set(), set()
+	if running_tasks:
+		stopped, stuck = await asyncio.wait(running_tasks, timeout=max(timeout - (monotonic() - start), 1))
+
 	await tg_stop()
+
+	# only now that everything we had in memory has been written out can another process take over,
+	# or it'd start from stale reputation, expiry deadlines and such, and run its background tasks alongside ours
+	tg_release()
 	await Tortoise.close_connections()
 
+	report = f"Shut down in {monotonic() - start:.1f}s: {drained} in-flight updates handled, {fired} pending timers fired, {len(stopped)} tasks stopped"
+	if cut_off or stuck:
+		logger.warning(f"{report}, but {cut_off} in-flight updates and {len(stuck)} tasks were cut off after {TG_DRAIN_TIMEOUT}")
+	else:
+		logger.info(report)
+
+async def main(stopping: asyncio.Event):
+	# out here, since the database connections belong to whichever task sets them up
+	await init_db()
+
+	# startup can take a while (waiting for the old process to hand over, or for telegram to let us in),
+	# and we still want to hear about it if we're asked to stop in the meantime
+	starting = asyncio.ensure_future(startup())
+	stopped = asyncio.ensure_future(stopping.wait())
+	await asyncio.wait({starting, stopped}, return_when=asyncio.FIRST_COMPLETED)
+	if not starting.done():
+		logger.info("Quitting before we finished starting up...")
+		starting.cancel()
+		await asyncio.wait({starting})
+		await tg_stop()
+		tg_release()
+		await Tortoise.close_connections()
+		return
+
+	stopped.cancel()
+	starting.result() # if startup failed, so do we
+	await stopping.wait()
+	logger.info("Quitting...")
+	await shutdown()
+
 
 if __name__ == '__main__':
-	logger.info("(Press Ctrl+C to stop this)")
-	while True:
-		loop = asyncio.new_event_loop()
-		task = loop.create_task(startup())
-		try:
-			loop.run_forever()
-		except KeyboardInterrupt as e:
-			logger.info("Quitting...")
-			task.cancel()
-			loop.run_until_complete(shutdown())
-			break
-		finally:
-			loop.close()
+	logger.info("(Press Ctrl+C or send SIGTERM to stop this)")
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	stopping = asyncio.Event()
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(sig, stopping.set)
+	try:
+		loop.run_until_complete(main(stopping))
+	finally:
+		loop.close()
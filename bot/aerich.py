@@ -1,8 +1,7 @@
 import logging
-from logging.config import dictConfig
-from .logconfig import LOGCONFIG_DICT
+from .logconfig import configure_logging
 
-dictConfig(LOGCONFIG_DICT)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 import os
@@ -0,0 +1,212 @@
+import logging
+import uuid
+
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+from tortoise import fields
+from tortoise.models import Model
+from tortoise.transactions import in_transaction
+
+from bot.models import TelegramUser, TelegramChat
+from bot.poll.models import Poll, PollType, Vote, VoteChoice
+
+logger = logging.getLogger(__name__)
+
+# ended polls (and their votes) get moved here once they're older than ARCHIVE__RETENTION
+# so that the live poll/vote tables only hold active and recent polls
+class ArchivedPoll(Model):
+    poll_id: uuid.UUID = fields.UUIDField(pk=True, description="Unique poll id, same as the original Poll")
+    timestamp: datetime = fields.DatetimeField(null=False, description="Time of poll")
+    poll_type: PollType = fields.IntEnumField(enum_type=PollType, null=False, default=PollType.BAN, description="type of poll")
+    chat: TelegramChat = fields.ForeignKeyField("models.TelegramChat", null=False, on_delete=fields.RESTRICT, related_name=False, description="chat in which the poll was started")
+    source: TelegramUser = fields.ForeignKeyField("models.TelegramUser", null=False, on_delete=fields.RESTRICT, related_name=False, description="user who initiated the poll")
+    target: TelegramUser = fields.ForeignKeyField("models.TelegramUser", null=False, on_delete=fields.RESTRICT, related_name=False, description="target of the poll")
+    forced: bool = fields.BooleanField(null=False, default=False, description="was this poll forced, e.g. started by an admin?")
+    msg_id: int = fields.IntField(null=True, description="message ID that bob was called on")
+    poll_msg_id: int = fields.IntField(null=True, description="msg id of poll message")
+    outcome: VoteChoice = fields.IntEnumField(enum_type=VoteChoice, null=True, description="winning choice, or null if the poll ended without one")
+    archived_at: datetime = fields.DatetimeField(null=False, auto_now_add=True, description="Time of archival")
+
+    """
+    Moves a batch of ended polls older than `before` (and their votes) into the archive tables,
+    and folds them into the PollDailyStats and VoterStats rollups.
+
+    Arguments:
+    - before (datetime): only polls started before this are archived
+    - batch_size (int): max number of polls to move in one go
+
+    Returns:
+    number of polls archived; anything less than batch_size means we're done
+    """
+    @classmethod
+    async def archive_batch(cls, before: datetime, batch_size: int = 500) -> int:
+        async with in_transaction():
+            polls: List[Poll] = await Poll.filter(ended=True, timestamp__lt=before).order_by('timestamp').limit(batch_size)
+            if not polls:
+                return 0
+
+            poll_ids: List[uuid.UUID] = [poll.poll_id for poll in polls]
+            votes: List[Vote] = await Vote.filter(poll_id__in=poll_ids)
+
+            tallies: Dict[uuid.UUID, Dict[VoteChoice, int]] = {poll_id: dict() for poll_id in poll_ids}
+            for vote in votes:
+                tally = tallies[vote.poll_id]
+                tally[vote.choice] = tally.get(vote.choice, 0) + 1
+
+            outcomes: Dict[uuid.UUID, Optional[VoteChoice]] = {
+                poll.poll_id: next((choice for choice, count in tallies[poll.poll_id].items() if count >= poll.get_threshold()), None)
+                for poll in polls
+            }
+
+            await ArchivedPoll.bulk_create([
+                ArchivedPoll(
+                    poll_id=poll.poll_id,
+                    timestamp=poll.timestamp,
+                    poll_type=poll.poll_type,
+                    chat_id=poll.chat_id,
+                    source_id=poll.source_id,
+                    target_id=poll.target_id,
+                    forced=poll.forced,
+                    msg_id=poll.msg_id,
+                    poll_msg_id=poll.poll_msg_id,
+                    outcome=outcomes[poll.poll_id],
+                ) for poll in polls
+            ])
+            await ArchivedVote.bulk_create([
+                ArchivedVote(
+                    vote_id=vote.vote_id,
+                    poll_id=vote.poll_id,
+                    user_id=vote.user_id,
+                    choice=vote.choice,
+                    timestamp=vote.timestamp,
+                ) for vote in votes
+            ])
+
+            await PollDailyStats.add_polls(polls, outcomes)
+            await VoterStats.add_votes({poll.poll_id: poll.chat_id for poll in polls}, votes)
+
+            # votes first, since vote.poll is ON DELETE RESTRICT
+            await Vote.filter(poll_id__in=poll_ids).delete()
+            await Poll.filter(poll_id__in=poll_ids).delete()
+
+        logger.info(f"Archived {len(polls)} polls and {len(votes)} votes from before {before}")
+        return len(polls)
+
+class ArchivedVote(Model):
+    vote_id: uuid.UUID = fields.UUIDField(pk=True, description="Unique vote id, same as the original Vote")
+    poll: ArchivedPoll = fields.ForeignKeyField("models.ArchivedPoll", on_delete=fields.RESTRICT)
+    user: TelegramUser = fields.ForeignKeyField("models.TelegramUser", on_delete=fields.RESTRICT, related_name=False, description="user that cast this vote")
+    choice: VoteChoice = fields.IntEnumField(enum_type=VoteChoice, null=False, description="choice selected by user")
+    timestamp: datetime = fields.DatetimeField(null=False, description="Time of first vote")
+
+    class Meta:
+        unique_together = (("poll", "user"),)
+
+# rollup: number of archived polls (and how they turned out) per chat per day
+class PollDailyStats(Model):
+    id: int = fields.IntField(pk=True)
+    chat: TelegramChat = fields.ForeignKeyField("models.TelegramChat", null=False, on_delete=fields.RESTRICT, related_name=False, description="chat the polls were started in")
+    day: date = fields.DateField(null=False, description="day (UTC) the polls were started on")
+    poll_type: PollType = fields.IntEnumField(enum_type=PollType, null=False, default=PollType.BAN, description="type of poll")
+    polls: int = fields.IntField(null=False, default=0, description="number of polls started")
+    banned: int = fields.IntField(null=False, default=0, description="number of polls that ended with a yes")
+    cleared: int = fields.IntField(null=False, default=0, description="number of polls that ended with a no")
+    unresolved: int = fields.IntField(null=False, default=0, description="number of polls that ended without a winner")
+
+    class Meta:
+        unique_together = (("chat", "day", "poll_type"),)
+
+    @classmethod
+    async def add_polls(cls, polls: List[Poll], outcomes: Dict[uuid.UUID, Optional[VoteChoice]]):
+        keys: Dict[Tuple[int, date, PollType], List[Poll]] = dict()
+        for poll in polls:
+            keys.setdefault((poll.chat_id, poll.timestamp.date(), poll.poll_type), []).append(poll)
+
+        existing: Dict[Tuple[int, date, PollType], PollDailyStats] = {
+            (stats.chat_id, stats.day, stats.poll_type): stats
+            async for stats in PollDailyStats.filter(
+                chat_id__in={key[0] for key in keys},
+                day__in={key[1] for key in keys},
+            )
+        }
+
+        to_create: List[PollDailyStats] = []
+        to_update: List[PollDailyStats] = []
+        for key, key_polls in keys.items():
+            stats: Optional[PollDailyStats] = existing.get(key)
+            if stats is None:
+                stats = PollDailyStats(chat_id=key[0], day=key[1], poll_type=key[2])
+                to_create.append(stats)
+            else:
+                to_update.append(stats)
+
+            for poll in key_polls:
+                outcome: Optional[VoteChoice] = outcomes[poll.poll_id]
+                stats.polls += 1
+                if outcome == VoteChoice.YES:
+                    stats.banned += 1
+                elif outcome == VoteChoice.NO:
+                    stats.cleared += 1
+                else:
+                    stats.unresolved += 1
+
+        if to_create:
+            await PollDailyStats.bulk_create(to_create)
+        if to_update:
+            await PollDailyStats.bulk_update(to_update, fields=['polls', 'banned', 'cleared', 'unresolved'])
+
+# rollup: number of archived votes per user per chat, for "top voters" lists
+class VoterStats(Model):
+    id: int = fields.IntField(pk=True)
+    chat: TelegramChat = fields.ForeignKeyField("models.TelegramChat", null=False, on_delete=fields.RESTRICT, related_name=False, description="chat the votes were cast in")
+    user: TelegramUser = fields.ForeignKeyField("models.TelegramUser", null=False, on_delete=fields.RESTRICT, related_name=False, description="user that cast the votes")
+    votes: int = fields.IntField(null=False, default=0, description="total number of votes cast")
+    yes_votes: int = fields.IntField(null=False, default=0, description="number of yes votes cast")
+    no_votes: int = fields.IntField(null=False, default=0, description="number of no votes cast")
+
+    class Meta:
+        unique_together = (("chat", "user"),)
+
+    @classmethod
+    async def add_votes(cls, poll_chats: Dict[uuid.UUID, int], votes: List[Vote]):
+        if not votes:
+            return
+
+        keys: Dict[Tuple[int, int], List[Vote]] = dict()
+        for vote in votes:
+            keys.setdefault((poll_chats[vote.poll_id], vote.user_id), []).append(vote)
+
+        existing: Dict[Tuple[int, int], VoterStats] = {
+            (stats.chat_id, stats.user_id): stats
+            async for stats in VoterStats.filter(
+                chat_id__in={key[0] for key in keys},
+                user_id__in={key[1] for key in keys},
+            )
+        }
+
+        to_create: List[VoterStats] = []
+        to_update: List[VoterStats] = []
+        for key, key_votes in keys.items():
+            stats: Optional[VoterStats] = existing.get(key)
+            if stats is None:
+                stats = VoterStats(chat_id=key[0], user_id=key[1])
+                to_create.append(stats)
+            else:
+                to_update.append(stats)
+
+            for vote in key_votes:
+                stats.votes += 1
+                if vote.choice == VoteChoice.YES:
+                    stats.yes_votes += 1
+                elif vote.choice == VoteChoice.NO:
+                    stats.no_votes += 1
+
+        if to_create:
+            await VoterStats.bulk_create(to_create)
+        if to_update:
+            await VoterStats.bulk_update(to_update, fields=['votes', 'yes_votes', 'no_votes'])
+
+    @classmethod
+    async def top_voters(cls, chat: TelegramChat, limit: int = 10) -> List["VoterStats"]:
+        return await VoterStats.filter(chat=chat).order_by('-votes').limit(limit).prefetch_related('user')
@@ -0,0 +1,28 @@
+import asyncio
+import logging
+import pytz
+
+from datetime import datetime, timedelta
+
+from bot.archive.models import ArchivedPoll
+from bot.poll import chatconfig
+from config import ARCHIVE__RETENTION, ARCHIVE__INTERVAL, ARCHIVE__BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+async def task_archive():
+    # retention depends on each chat's limit duration, and outcomes of polls that don't have a threshold of their own on the chat's threshold
+    await chatconfig.loaded.wait()
+
+    while True:
+        try:
+            # Poll.poll_limit_reached counts every poll in the chat's limit duration,
+            # so we can't archive anything younger than the longest of those
+            retention: timedelta = max(ARCHIVE__RETENTION, chatconfig.max_limit_duration())
+            before: datetime = datetime.now(tz=pytz.utc) - retention
+            while await ArchivedPoll.archive_batch(before, ARCHIVE__BATCH_SIZE) >= ARCHIVE__BATCH_SIZE:
+                await asyncio.sleep(0) # let the handlers have a go in between batches
+        except Exception:
+            logger.exception("Got exception while archiving polls")
+
+        await asyncio.sleep(ARCHIVE__INTERVAL.total_seconds())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Runs handler_bob and handler_bob_callback through a few scenarios against an in-memory sqlite database
+and a stub client (see bot.stub), and checks that each one makes exactly as many database queries and
+telegram round-trips as budgeted below. Exits non-zero and prints what was run if anything's off.
+
+usage: python3 -m bot.budget [-v]
+
+If you've made something cheaper, lower its budget. If you've made something more expensive on purpose,
+raise it, and say why in the commit.
+
+Query counts depend on how tortoise goes about things, so the budgets are measured against the versions
+in poetry.lock (tortoise-orm 0.21.6 with aiosqlite 0.17.0, telethon 1.36.0). When upgrading any of those,
+re-measure them in the same commit.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import warnings
+
+from typing import Dict, List, Tuple
+
+from tortoise import Tortoise
+
+# scenario -> (database queries, telegram round-trips)
+# every scenario starts with a cold participant cache, and runs right after the one before it
+BUDGETS: Dict[str, Tuple[int, int]] = {
+    'new poll': (14, 7),
+    'repeat /bob': (13, 7),
+    'first vote': (10, 5),
+    'duplicate vote': (7, 3),
+    'threshold vote': (17, 10),
+}
+
+CHAT_ID = -1001000000001
+SOURCE_ID = 1001
+TARGET_ID = 1002
+
+# counts every query tortoise sends, transactions included
+class QueryCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.queries: List[str] = []
+
+    def emit(self, record: logging.LogRecord):
+        self.queries.append(record.getMessage())
+
+async def run(verbose: bool) -> int:
+    await Tortoise.init(db_url='sqlite://:memory:', modules={'models': ['bot.models', 'bot.poll.models']}, use_tz=True)
+    try:
+        await Tortoise.generate_schemas()
+        return await run_scenarios(verbose)
+    finally:
+        await Tortoise.close_connections()
+
+async def run_scenarios(verbose: bool) -> int:
+    from bot.poll import chatconfig, propagation, telegram
+    from bot.poll.models import ChatPollConfig, Poll
+    from bot.stub import StubCallbackQuery, StubClient, StubNewMessage
+    from config import POLL__THRESHOLD
+    assert POLL__THRESHOLD >= 4, "the scenarios need a POLL__THRESHOLD of at least 4"
+
+    stub = StubClient(chat_ids=[CHAT_ID])
+    telegram.client = stub
+    propagation.POLL__PROPAGATE_BANS = True # budgets include adding the target to the ban list
+    await ChatPollConfig.reload() # CHAT_ID has no settings of its own, so it goes by POLL__*
+    chatconfig.chats.add(CHAT_ID)
+
+    counter = QueryCounter()
+    db_logger = logging.getLogger('tortoise.db_client')
+    db_logger.addHandler(counter)
+    db_logger.setLevel(logging.DEBUG)
+    db_logger.propagate = False
+
+    for user_id in (SOURCE_ID, TARGET_ID, *range(2001, 2001 + POLL__THRESHOLD)):
+        stub.add_user(user_id)
+
+    spam = stub.message(CHAT_ID, TARGET_ID, "totally legit crypto giveaway, send 1 btc to get 2 back at https://example.com/free")
+
+    def bob(sender_id: int) -> StubNewMessage:
+        return StubNewMessage(stub, stub.message(CHAT_ID, sender_id, '/bob', reply_to=spam), telegram.regex_bob.match)
+
+    async def vote(sender_id: int, choice: str = 'yes') -> StubCallbackQuery:
+        poll: Poll = await Poll.get(ended=False)
+        return StubCallbackQuery(stub, stub.messages[(CHAT_ID, poll.poll_msg_id)], sender_id, f"poll_vote {poll.poll_id} {choice}".encode('ascii'))
+
+    voters = iter(range(2001, 2001 + POLL__THRESHOLD))
+    first_voter: int = next(voters)
+
+    async def fill_up():
+        # source + repeat /bob + first vote got us 3 yes votes; get it to one short of the threshold
+        for _ in range(POLL__THRESHOLD - 4):
+            await telegram.handler_bob_callback(await vote(next(voters)))
+
+    async def nothing():
+        pass
+
+    # (name, setup that doesn't count, handler, event)
+    scenarios = [
+        ('new poll', nothing, telegram.handler_bob, lambda: bob(SOURCE_ID)),
+        ('repeat /bob', nothing, telegram.handler_bob, lambda: bob(next(voters))),
+        ('first vote', nothing, telegram.handler_bob_callback, lambda: vote(first_voter)),
+        ('duplicate vote', nothing, telegram.handler_bob_callback, lambda: vote(first_voter)),
+        ('threshold vote', fill_up, telegram.handler_bob_callback, lambda: vote(next(voters))),
+    ]
+
+    failed: int = 0
+    for name, setup, handler, make_event in scenarios:
+        await setup()
+        event = make_event()
+        if asyncio.iscoroutine(event):
+            event = await event
+
+        telegram.participant_cache.clear()
+        counter.queries.clear()
+        stub.rpcs.clear()
+
+        await handler(event)
+
+        queries: int = len(counter.queries)
+        rpcs: int = sum(stub.rpcs.values())
+        budget_queries, budget_rpcs = BUDGETS[name]
+        ok: bool = (queries, rpcs) == (budget_queries, budget_rpcs)
+        print(f"{'ok  ' if ok else 'FAIL'} {name:<16} queries {queries:>3} (budget {budget_queries:>3})  rpcs {rpcs:>3} (budget {budget_rpcs:>3})")
+
+        if not ok or verbose:
+            for query in counter.queries:
+                print(f"       {query}")
+            for rpc, count in sorted(stub.rpcs.items()):
+                print(f"       {rpc} x{count}")
+        if not ok:
+            failed += 1
+
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m bot.budget')
+    parser.add_argument('-v', '--verbose', action='store_true', help="print every query and round-trip, not just for failures")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    warnings.filterwarnings('ignore', message='.*received a naive datetime', category=RuntimeWarning) # TelegramUser/TelegramChat use utcnow()
+    failed: int = asyncio.run(run(args.verbose))
+    if failed:
+        print(f"{failed} scenario(s) went over or under budget")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Shows or changes per-chat poll settings (see ChatPollConfig in bot.poll.models). A running bot picks up
+changes within POLL__CONFIG_RELOAD_INTERVAL, no restart needed.
+
+usage: python3 -m bot.chats list
+       python3 -m bot.chats set CHAT_ID [--enable | --disable] [--threshold N] [--limit N] [--limit-duration HOURS]
+       python3 -m bot.chats remove CHAT_ID
+
+`set` only changes what's given; pass `default` as a value to go back to the POLL__* setting.
+Chats that have settings of their own run polls unless they've been --disable'd.
+`remove` forgets everything about a chat, so it goes back to whether it's in POLL__CHANNELS.
+"""
+import argparse
+import asyncio
+import logging
+
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from tortoise import Tortoise
+
+from .aerich import TORTOISE_ORM
+from .poll import chatconfig
+from .poll.models import ChatPollConfig
+
+logger = logging.getLogger(__name__)
+
+def count_or_default(value: str) -> Optional[int]:
+    if value == 'default':
+        return None
+    count: int = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return count
+
+def hours_or_default(value: str) -> Optional[timedelta]:
+    if value == 'default':
+        return None
+    hours: float = float(value)
+    if hours <= 0:
+        raise argparse.ArgumentTypeError("must be more than 0")
+    return timedelta(hours=hours)
+
+def show(value: Any, default: Any) -> str:
+    return f"{value}" if value is not None else f"({default})"
+
+async def list_chats():
+    rows: Dict[int, ChatPollConfig] = {row.chat_id: row for row in await ChatPollConfig.all()}
+    defaults: chatconfig.ChatSettings = chatconfig.defaults
+
+    print(f"{'chat':<16} {'enabled':<8} {'threshold':>10} {'limit':>7} {'limit duration':>18}")
+    for chat_id in sorted(set(rows) | chatconfig.channels):
+        row: Optional[ChatPollConfig] = rows.get(chat_id)
+        if row is None:
+            print(f"{chat_id:<16} {'(yes)':<8} {show(None, defaults.threshold):>10} {show(None, defaults.limit):>7} {show(None, defaults.limit_duration):>18}")
+            continue
+        print(f"{chat_id:<16} {'yes' if row.enabled else 'no':<8} {show(row.threshold, defaults.threshold):>10} {show(row.limit, defaults.limit):>7} {show(row.limit_duration, defaults.limit_duration):>18}")
+    for chat in chatconfig.unresolved:
+        # usernames and links, which only the bot looks up
+        print(f"{chat:<16} {'(yes)':<8} {show(None, defaults.threshold):>10} {show(None, defaults.limit):>7} {show(None, defaults.limit_duration):>18}")
+    print("(values in brackets are defaults from config)")
+
+async def main(args: argparse.Namespace):
+    await Tortoise.init(config=TORTOISE_ORM, use_tz=True)
+    try:
+        await Tortoise.generate_schemas(safe=True)
+
+        if args.command == 'list':
+            await list_chats()
+        elif args.command == 'set':
+            changes: Dict[str, Any] = {field: getattr(args, field) for field in ('enabled', 'threshold', 'limit', 'limit_duration') if hasattr(args, field)}
+            if not changes:
+                raise SystemExit("nothing to change")
+            await ChatPollConfig.put(args.chat_id, **changes)
+            await list_chats()
+        elif args.command == 'remove':
+            deleted: int = await ChatPollConfig.filter(chat_id=args.chat_id).delete()
+            if not deleted:
+                raise SystemExit(f"{args.chat_id} has no settings of its own")
+            logger.info(f"Removed poll settings for {args.chat_id}")
+            await list_chats()
+    finally:
+        await Tortoise.close_connections()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m bot.chats')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('list', help="show every chat with settings of its own, and every chat in POLL__CHANNELS")
+
+    set_parser = commands.add_parser('set', help="change the settings for a chat", argument_default=argparse.SUPPRESS)
+    set_parser.add_argument('chat_id', type=int, help="marked chat id, e.g. -1001234567890")
+    group = set_parser.add_mutually_exclusive_group()
+    group.add_argument('--enable', dest='enabled', action='store_const', const=True, help="run polls in this chat")
+    group.add_argument('--disable', dest='enabled', action='store_const', const=False, help="stop running polls in this chat")
+    set_parser.add_argument('--threshold', type=count_or_default, help="number of votes before we process an action")
+    set_parser.add_argument('--limit', type=count_or_default, help="maximum number of polls allowed in --limit-duration")
+    set_parser.add_argument('--limit-duration', type=hours_or_default, help="in hours")
+
+    remove_parser = commands.add_parser('remove', help="forget the settings for a chat")
+    remove_parser.add_argument('chat_id', type=int, help="marked chat id, e.g. -1001234567890")
+
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import traceback
+
+from collections import Counter
+from datetime import datetime
+from time import monotonic, sleep
+from types import FrameType
+from typing import Dict, Optional
+
+from config import DEBUG__PROFILE_DIR, DEBUG__PROFILE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+# watches the event loop from the outside: the loop is supposed to call beat() every so often,
+# and if it doesn't for longer than `threshold` seconds, whatever it's stuck in gets logged
+class LagWatchdog(threading.Thread):
+    def __init__(self, loop_thread_id: int, threshold: float, interval: float):
+        super().__init__(name='LagWatchdog', daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat: float = monotonic()
+        self._stop_event = threading.Event()
+
+    def beat(self):
+        self.heartbeat = monotonic()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        reported: Optional[float] = None # heartbeat we've already dumped a stack for
+        while not self._stop_event.wait(self.interval):
+            heartbeat: float = self.heartbeat
+            stalled: float = monotonic() - heartbeat
+            if stalled > self.threshold and reported != heartbeat:
+                reported = heartbeat
+                frame: Optional[FrameType] = sys._current_frames().get(self.loop_thread_id)
+                stack: str = ''.join(traceback.format_stack(frame)) if frame else '(no stack)'
+                logger.warning(f"Event loop has been blocked for {stalled * 1000:.0f}ms, currently in:\n{stack}")
+
+_profiling = threading.Lock()
+
+def sample(thread_id: int, duration: float, interval: float) -> Dict[str, int]:
+    stacks: Counter = Counter()
+    end: float = monotonic() + duration
+    while monotonic() < end:
+        frame: Optional[FrameType] = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[collapse_stack(frame)] += 1
+        del frame
+        sleep(interval)
+    return stacks
+
+"""
+Samples the stack of the thread running the event loop every DEBUG__PROFILE_INTERVAL for `duration` seconds,
+and writes the result as collapsed stacks (one `frame;frame;frame count` line each), which is what
+flamegraph.pl, speedscope, etc. take as input.
+
+Returns:
+path of the profile that was written
+
+Raises:
+RuntimeError if a profile is already running
+"""
+async def profile_loop(duration: float) -> str:
+    if not _profiling.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+
+    try:
+        logger.info(f"Profiling the event loop for {duration}s")
+        stacks: Dict[str, int] = await asyncio.to_thread(sample, threading.get_ident(), duration, DEBUG__PROFILE_INTERVAL.total_seconds())
+
+        path: str = os.path.join(DEBUG__PROFILE_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        def write():
+            with open(path, 'w') as f:
+                for stack, count in stacks.items():
+                    f.write(f"{stack} {count}\n")
+        await asyncio.to_thread(write)
+
+        logger.info(f"Wrote profile with {sum(stacks.values())} samples to {path}")
+        return path
+    finally:
+        _profiling.release()
@@ -0,0 +1,41 @@
+import asyncio
+import logging
+import signal
+import threading
+
+from time import monotonic
+
+from bot.debug.profiler import LagWatchdog, profile_loop
+from config import DEBUG__LAG_INTERVAL, DEBUG__LAG_THRESHOLD, DEBUG__PROFILE_DURATION
+
+logger = logging.getLogger(__name__)
+
+async def task_lag_watchdog():
+    interval: float = DEBUG__LAG_INTERVAL.total_seconds()
+    threshold: float = DEBUG__LAG_THRESHOLD.total_seconds()
+
+    watchdog = LagWatchdog(threading.get_ident(), threshold, interval)
+    watchdog.start()
+
+    try:
+        while True:
+            start: float = monotonic()
+            await asyncio.sleep(interval)
+            watchdog.beat()
+
+            # how much later than asked we got woken up
+            lag: float = monotonic() - start - interval
+            if lag > threshold:
+                logger.warning(f"Event loop lag of {lag * 1000:.0f}ms")
+    finally:
+        watchdog.stop()
+
+async def profile_on_signal():
+    try:
+        await profile_loop(DEBUG__PROFILE_DURATION.total_seconds())
+    except RuntimeError as e:
+        logger.warning(f"Not profiling: {e}")
+
+async def task_profile_signal():
+    # `kill -USR2 <pid>` profiles the event loop for DEBUG__PROFILE_DURATION
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(profile_on_signal()))
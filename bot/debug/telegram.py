@@ -0,0 +1,43 @@
+import logging
+import re
+
+from telethon import events
+from telethon.events.newmessage import NewMessage
+
+from bot.debug.profiler import profile_loop
+from config import TG_BOT_USERNAME, TG_LOG_CHANNEL, DEBUG__PROFILE_DURATION, DEBUG__PROFILE_MAX_DURATION, DEBUG__PROFILE_USERS
+
+logger = logging.getLogger(__name__)
+
+# whoever posts in the log channel might not be someone we want stalling the bot for minutes on end
+async def can_profile(event: NewMessage) -> bool:
+    if event.sender_id in DEBUG__PROFILE_USERS:
+        return True
+    if event.is_channel and not event.is_group:
+        return True # only admins can post in a broadcast channel
+
+    try:
+        permissions = await event.client.get_permissions(event.chat_id, event.sender_id)
+    except Exception:
+        logger.exception(f"Got exception while checking whether {event.sender_id} can /profile")
+        return False
+    return permissions.is_admin
+
+regex_profile = re.compile(fr'^/profile(?:@{TG_BOT_USERNAME})?(?: +(?P<seconds>\d+))?$', re.I)
+@events.register(events.NewMessage(incoming=True, pattern=regex_profile, chats=TG_LOG_CHANNEL))
+async def handler_profile(event: NewMessage):
+    if not await can_profile(event):
+        logger.warning(f"Ignoring /profile from {event.sender_id}, who isn't an admin of the log channel")
+        return
+
+    seconds: int = int(event.pattern_match.group('seconds') or DEBUG__PROFILE_DURATION.total_seconds())
+    seconds = max(min(seconds, int(DEBUG__PROFILE_MAX_DURATION.total_seconds())), 1)
+
+    await event.reply(f"Profiling the event loop for {seconds}s...")
+    try:
+        path: str = await profile_loop(seconds)
+    except RuntimeError as e:
+        await event.reply(str(e))
+        return
+
+    await event.reply(f"Done, saved to <code>{path}</code>", file=path, force_document=True)
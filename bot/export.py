@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Streams poll and vote history out of the database, a chunk of polls at a time.
+
+usage: python3 -m bot.export [--format jsonl|csv|parquet] [--output FILE] [--chat CHAT_ID ...]
+                             [--since DATE] [--until DATE] [--archived] [--checkpoint FILE]
+
+Polls are read in (timestamp, poll_id) order with keyset pagination, so memory use
+stays flat no matter how much history there is. With --checkpoint, the position of the
+last exported poll is saved after every chunk, along with how much of the output file
+had been written by then. A rerun with the same checkpoint cuts the output file back to
+that length (dropping anything written after the last checkpoint) and picks up where the
+previous one stopped.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import uuid
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, TextIO, Tuple, Type
+
+from tortoise import Tortoise
+from tortoise.expressions import Q
+from tortoise.models import Model
+
+from .aerich import TORTOISE_ORM
+from .models import TelegramUser, TelegramChat
+from .poll import chatconfig
+from .poll.models import ChatPollConfig, Poll, Vote, VoteChoice
+from .archive.models import ArchivedPoll, ArchivedVote
+
+logger = logging.getLogger(__name__)
+
+CSV_FIELDS = [
+    'poll_id', 'timestamp', 'poll_type', 'chat_id', 'chat_title',
+    'source_id', 'source_username', 'source_name',
+    'target_id', 'target_username', 'target_name',
+    'forced', 'outcome', 'msg_id', 'poll_msg_id',
+    'vote_user_id', 'vote_username', 'vote_name', 'vote_choice', 'vote_timestamp',
+]
+
+def user_dict(users: Dict[int, Dict[str, Any]], user_id: int) -> Dict[str, Any]:
+    user: Dict[str, Any] = users.get(user_id, {})
+    name: str = ' '.join(filter(None, (user.get('first_name'), user.get('last_name'))))
+    return {"user_id": user_id, "username": user.get('username'), "name": name or None}
+
+def flatten(record: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+    row: Dict[str, Any] = {
+        'poll_id': record['poll_id'],
+        'timestamp': record['timestamp'],
+        'poll_type': record['poll_type'],
+        'chat_id': record['chat_id'],
+        'chat_title': record['chat_title'],
+        'source_id': record['source']['user_id'],
+        'source_username': record['source']['username'],
+        'source_name': record['source']['name'],
+        'target_id': record['target']['user_id'],
+        'target_username': record['target']['username'],
+        'target_name': record['target']['name'],
+        'forced': record['forced'],
+        'outcome': record['outcome'],
+        'msg_id': record['msg_id'],
+        'poll_msg_id': record['poll_msg_id'],
+    }
+
+    if not record['votes']:
+        yield {**row, 'vote_user_id': None, 'vote_username': None, 'vote_name': None, 'vote_choice': None, 'vote_timestamp': None}
+
+    for vote in record['votes']:
+        yield {
+            **row,
+            'vote_user_id': vote['user']['user_id'],
+            'vote_username': vote['user']['username'],
+            'vote_name': vote['user']['name'],
+            'vote_choice': vote['choice'],
+            'vote_timestamp': vote['timestamp'],
+        }
+
+def close_output(f: TextIO):
+    if f is sys.stdout:
+        f.flush() # not ours to close
+    else:
+        f.close()
+
+class JsonlWriter:
+    def __init__(self, f: TextIO):
+        self._f = f
+
+    def write(self, records: List[Dict[str, Any]]):
+        for record in records:
+            self._f.write(json.dumps(record, ensure_ascii=False))
+            self._f.write('\n')
+        self._f.flush()
+
+    def close(self):
+        close_output(self._f)
+
+# one row per vote, polls without votes get a single row with empty vote columns
+class CsvWriter:
+    def __init__(self, f: TextIO, resume: bool):
+        self._f = f
+        self._writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        if not resume:
+            self._writer.writeheader()
+
+    def write(self, records: List[Dict[str, Any]]):
+        for record in records:
+            self._writer.writerows(flatten(record))
+        self._f.flush()
+
+    def close(self):
+        close_output(self._f)
+
+# same rows as CsvWriter, one row group per chunk. needs pyarrow, which isn't a dependency
+class ParquetWriter:
+    def __init__(self, path: str, resume: bool):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("parquet output requires pyarrow (pip3 install pyarrow)")
+
+        if resume:
+            raise SystemExit("parquet files can't be appended to, so --checkpoint can't resume into one")
+
+        int_fields = {'chat_id', 'source_id', 'target_id', 'msg_id', 'poll_msg_id', 'vote_user_id'}
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([
+            (field, pyarrow.int64() if field in int_fields else pyarrow.bool_() if field == 'forced' else pyarrow.string())
+            for field in CSV_FIELDS
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def write(self, records: List[Dict[str, Any]]):
+        rows: List[Dict[str, Any]] = [row for record in records for row in flatten(record)]
+        self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+"""
+Returns:
+((timestamp, poll_id) of the last exported poll, length of the output file at that point or None if unknown),
+or None if there's no checkpoint to resume from
+"""
+def read_checkpoint(path: Optional[str]) -> Optional[Tuple[Tuple[datetime, uuid.UUID], Optional[int]]]:
+    if not path or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        data: Dict[str, Any] = json.load(f)
+    return (datetime.fromisoformat(data['timestamp']), uuid.UUID(data['poll_id'])), data.get('offset')
+
+def write_checkpoint(path: str, timestamp: datetime, poll_id: uuid.UUID, offset: Optional[int]):
+    # write to a temp file and rename, so we never leave a half-written checkpoint behind
+    tmp_path: str = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({"timestamp": timestamp.isoformat(), "poll_id": str(poll_id), "offset": offset}, f)
+    os.replace(tmp_path, path)
+
+"""
+opens the output file, cutting it back to `offset` bytes when resuming, so that anything written
+after the last checkpoint was saved doesn't end up in there twice
+"""
+def open_output(path: str, resume: bool, offset: Optional[int]) -> TextIO:
+    if not resume:
+        return open(path, 'w', newline='', encoding='utf-8')
+
+    f: TextIO = open(path, 'a', newline='', encoding='utf-8')
+    if offset is not None:
+        if f.tell() < offset:
+            f.close()
+            raise SystemExit(f"{path} is shorter than when the checkpoint was saved, so it can't be resumed into")
+        f.truncate(offset)
+    return f
+
+async def export_chunks(poll_model: Type[Model], vote_model: Type[Model], chats: Optional[List[int]], since: Optional[datetime], until: Optional[datetime], after: Optional[Tuple[datetime, uuid.UUID]], chunk_size: int):
+    archived: bool = poll_model is ArchivedPoll
+    poll_fields: List[str] = ['poll_id', 'timestamp', 'poll_type', 'chat_id', 'source_id', 'target_id', 'forced', 'msg_id', 'poll_msg_id']
+    poll_fields += ['outcome'] if archived else ['ended', 'threshold']
+
+    base_filter: Q = Q()
+    if chats:
+        base_filter &= Q(chat_id__in=chats)
+    if since:
+        base_filter &= Q(timestamp__gte=since)
+    if until:
+        base_filter &= Q(timestamp__lt=until)
+
+    while True:
+        chunk_filter: Q = base_filter
+        if after is not None:
+            chunk_filter &= Q(timestamp__gt=after[0]) | Q(timestamp=after[0], poll_id__gt=after[1])
+
+        polls: List[Dict[str, Any]] = await poll_model.filter(chunk_filter).order_by('timestamp', 'poll_id').limit(chunk_size).values(*poll_fields)
+        if not polls:
+            return
+
+        poll_ids: List[uuid.UUID] = [poll['poll_id'] for poll in polls]
+        votes: List[Dict[str, Any]] = await vote_model.filter(poll_id__in=poll_ids).order_by('timestamp').values('poll_id', 'user_id', 'choice', 'timestamp')
+
+        user_ids = {vote['user_id'] for vote in votes} | {poll['source_id'] for poll in polls} | {poll['target_id'] for poll in polls}
+        users: Dict[int, Dict[str, Any]] = {user['user_id']: user for user in await TelegramUser.filter(user_id__in=user_ids).values('user_id', 'username', 'first_name', 'last_name')}
+        chat_titles: Dict[int, str] = dict(await TelegramChat.filter(chat_id__in={poll['chat_id'] for poll in polls}).values_list('chat_id', 'chat_title'))
+
+        poll_votes: Dict[uuid.UUID, List[Dict[str, Any]]] = {poll_id: [] for poll_id in poll_ids}
+        for vote in votes:
+            poll_votes[vote['poll_id']].append({
+                "user": user_dict(users, vote['user_id']),
+                "choice": VoteChoice(vote['choice']).name,
+                "timestamp": vote['timestamp'].isoformat(),
+            })
+
+        records: List[Dict[str, Any]] = []
+        for poll in polls:
+            if archived:
+                outcome: Optional[str] = VoteChoice(poll['outcome']).name if poll['outcome'] is not None else None
+            else:
+                # live polls don't store their outcome, so derive it from the tally and the poll's threshold
+                # (or the chat's current one, for polls from before we kept track of that)
+                outcome = None
+                if poll['ended']:
+                    threshold: int = poll['threshold'] if poll['threshold'] is not None else chatconfig.get(poll['chat_id']).threshold
+                    tally: Dict[str, int] = dict()
+                    for vote in poll_votes[poll['poll_id']]:
+                        tally[vote['choice']] = tally.get(vote['choice'], 0) + 1
+                    outcome = next((choice for choice, count in tally.items() if count >= threshold), None)
+
+            records.append({
+                "poll_id": str(poll['poll_id']),
+                "timestamp": poll['timestamp'].isoformat(),
+                "poll_type": poll['poll_type'].name,
+                "chat_id": poll['chat_id'],
+                "chat_title": chat_titles.get(poll['chat_id']),
+                "source": user_dict(users, poll['source_id']),
+                "target": user_dict(users, poll['target_id']),
+                "forced": poll['forced'],
+                "outcome": outcome,
+                "msg_id": poll['msg_id'],
+                "poll_msg_id": poll['poll_msg_id'],
+                "votes": poll_votes[poll['poll_id']],
+            })
+
+        after = (polls[-1]['timestamp'], polls[-1]['poll_id'])
+        yield records, after
+
+        if len(polls) < chunk_size:
+            return
+
+async def export(args: argparse.Namespace):
+    checkpoint: Optional[Tuple[Tuple[datetime, uuid.UUID], Optional[int]]] = read_checkpoint(args.checkpoint)
+    after: Optional[Tuple[datetime, uuid.UUID]] = checkpoint[0] if checkpoint else None
+    resume: bool = after is not None
+    if resume:
+        logger.info(f"Resuming export after poll {after[1]} ({after[0]})")
+
+    if args.format == 'parquet':
+        if args.output == '-':
+            raise SystemExit("parquet output needs an --output file")
+        writer = ParquetWriter(args.output, resume)
+    else:
+        f: TextIO = sys.stdout if args.output == '-' else open_output(args.output, resume, checkpoint[1] if checkpoint else None)
+        writer = CsvWriter(f, resume) if args.format == 'csv' else JsonlWriter(f)
+
+    await Tortoise.init(config=TORTOISE_ORM, use_tz=True)
+    try:
+        await ChatPollConfig.reload() # for the outcomes of live polls
+        poll_model, vote_model = (ArchivedPoll, ArchivedVote) if args.archived else (Poll, Vote)
+        exported: int = 0
+        async for records, after in export_chunks(poll_model, vote_model, args.chat, args.since, args.until, after, args.chunk_size):
+            writer.write(records)
+            exported += len(records)
+            if args.checkpoint:
+                # writers flush after every chunk, so this is everything we've written so far.
+                # there's no going back on stdout, so we don't keep track of it there
+                offset: Optional[int] = f.tell() if args.format != 'parquet' and f is not sys.stdout else None
+                write_checkpoint(args.checkpoint, *after, offset)
+
+        logger.info(f"Exported {exported} polls")
+    finally:
+        writer.close()
+        await Tortoise.close_connections()
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python3 -m bot.export', description="Export poll and vote history.")
+    parser.add_argument('--format', choices=('jsonl', 'csv', 'parquet'), default='jsonl')
+    parser.add_argument('--output', default='-', help="output file, or - for stdout (default)")
+    parser.add_argument('--chat', type=int, action='append', help="only export polls from this chat id (can be repeated)")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="only export polls started at or after this time (ISO 8601, UTC if no offset)")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="only export polls started before this time (ISO 8601, UTC if no offset)")
+    parser.add_argument('--archived', action='store_true', help="export archived polls instead of live ones")
+    parser.add_argument('--chunk-size', type=int, default=500, help="number of polls fetched per query")
+    parser.add_argument('--checkpoint', help="file to save progress to, and resume from if it exists")
+
+    args = parser.parse_args(argv)
+
+    # timestamps are stored in UTC
+    for name in ('since', 'until'):
+        value: Optional[datetime] = getattr(args, name)
+        if value is not None and value.tzinfo is None:
+            setattr(args, name, value.replace(tzinfo=timezone.utc))
+
+    return args
+
+if __name__ == '__main__':
+    asyncio.run(export(parse_args()))
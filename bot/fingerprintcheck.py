@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Checks that the scam fingerprint index (see bot.poll.fingerprint) catches reposts of a scam with a word or
+two changed, and leaves unrelated messages alone. Exits non-zero and prints the estimated similarities if
+anything's off.
+
+usage: python3 -m bot.fingerprintcheck
+
+Run it after changing NUM_PERM, BANDS, SHINGLE_SIZE or POLL__FINGERPRINT_SIMILARITY.
+"""
+import sys
+
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+from bot.poll.fingerprint import FingerprintIndex, NUM_PERM, minhash
+from bot.poll.models import FingerprintKind
+from config import POLL__FINGERPRINT_SIMILARITY
+
+SCAM = "Hello everyone I just made 5000 dollars today trading bitcoin with Mr James Carter, message him on whatsapp now and start earning big from home"
+
+# (name, text, should it match SCAM?)
+CASES: List[Tuple[str, str, bool]] = [
+    ('verbatim', SCAM, True),
+    ('case changed', SCAM.upper(), True),
+    ('today -> now', SCAM.replace('today', 'now'), True),
+    ('new greeting', SCAM.replace('Hello everyone', 'Hi guys'), True),
+    ('greeting and today', SCAM.replace('Hello everyone', 'Good morning all').replace('today', 'now'), True),
+    ('amount and name', SCAM.replace('5000', '7000').replace('James Carter', 'Robert Smith'), True),
+    ('same topic', "Hello everyone, does anyone know when the next community meetup is? I'd like to bring some friends along and talk about trading bitcoin", False),
+    ('same words', "Hey, I just made coffee today and then went to the market with my friends, the weather is great for trading stories from home", False),
+    ('unrelated', "Can someone explain how the gas fees on the new chain compare to mainnet? I keep getting different numbers from different wallets", False),
+]
+
+def similarity(a: str, b: str) -> float:
+    return sum(1 for x, y in zip(minhash(a), minhash(b)) if x == y) / NUM_PERM
+
+def main() -> int:
+    index = FingerprintIndex()
+    index.add(SimpleNamespace(id=1, kind=FingerprintKind.MINHASH, value=minhash(SCAM).tobytes()))
+
+    failed: int = 0
+    for name, text, should_match in CASES:
+        fp_id: Optional[int] = index.match(text, ())
+        ok: bool = (fp_id is not None) == should_match
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name:<20} similarity {similarity(SCAM, text):.2f} (threshold {POLL__FINGERPRINT_SIMILARITY})  {'matched' if fp_id is not None else 'no match'}, {'should' if should_match else 'should not'}")
+
+    return failed
+
+if __name__ == '__main__':
+    failed: int = main()
+    if failed:
+        print(f"{failed} case(s) matched when they shouldn't have, or didn't when they should")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Measures how long a per-vote log call blocks the calling thread (i.e. the event loop)
+with the old synchronous handlers, the queue-based pipeline, and the queue plus sampling.
+
+usage: python3 -m bot.logbench [-n CALLS] [--disk-latency MS]
+
+--disk-latency adds a sleep to every file write, to see what a slow disk does to each setup.
+"""
+import argparse
+import copy
+import logging
+import os
+import tempfile
+import time
+
+from datetime import datetime, timezone
+
+from .logconfig import LOGCONFIG_DICT, configure_logging, stop_logging
+
+class SlowFileHandler(logging.FileHandler):
+    latency: float = 0
+
+    def emit(self, record: logging.LogRecord):
+        time.sleep(self.latency)
+        super().emit(record)
+
+# something with a repr about as expensive as TelegramUser's
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Some"
+        self.last_name = "User"
+        self.last_update = datetime.now(tz=timezone.utc)
+
+    def __repr__(self):
+        attrs = {"user_id": self.user_id, "username": self.username, "first_name": self.first_name, "last_name": self.last_name, "last_update": round(self.last_update.timestamp())}
+        return f"<TelegramUser({', '.join(f'{k}={v}' for k,v in attrs.items())})>"
+
+def build_config(variant: str, log_dir: str, devnull) -> dict:
+    config = copy.deepcopy(LOGCONFIG_DICT)
+    config['handlers']['console']['stream'] = devnull
+    del config['handlers']['file']['class']
+    config['handlers']['file']['()'] = SlowFileHandler
+    config['handlers']['file']['filename'] = os.path.join(log_dir, f'{variant}.log')
+
+    if variant == 'sync':
+        # what we used to have: handlers run right on the calling thread
+        del config['handlers']['queue']
+        config['loggers']['']['handlers'] = ['console', 'file']
+    if variant != 'queue+sampled':
+        del config['loggers']['bot.poll.models.votes']
+
+    return config
+
+def run(variant: str, calls: int, log_dir: str) -> float:
+    with open(os.devnull, 'w') as devnull:
+        configure_logging(build_config(variant, log_dir, devnull))
+        logger = logging.getLogger('bot.poll.models.votes')
+        user = FakeUser(12345)
+
+        start = time.perf_counter()
+        for i in range(calls):
+            logger.info("Creating new vote by %s for %s on poll %s with vote id %s", user, 'VoteChoice.YES', 'b0d4c1e2-0000-4000-8000-000000000000', i)
+        elapsed = time.perf_counter() - start
+
+        stop_logging() # wait for the background thread to catch up before the next run
+        logging.shutdown()
+    return elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m bot.logbench')
+    parser.add_argument('-n', '--calls', type=int, default=20000)
+    parser.add_argument('--disk-latency', type=float, default=0, help="extra milliseconds per file write")
+    args = parser.parse_args()
+
+    SlowFileHandler.latency = args.disk_latency / 1000
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        print(f"{args.calls} per-vote log calls, {args.disk_latency}ms extra per file write")
+        for variant in ('sync', 'queue', 'queue+sampled'):
+            elapsed = run(variant, args.calls, log_dir)
+            print(f"{variant:>14}: {elapsed * 1e6 / args.calls:8.2f}us per call on the calling thread ({elapsed:.3f}s total)")
@@ -1,5 +1,64 @@
 from config import TG_BOT_NAME
+import atexit
+import json
+import logging
+import logging.config
 import os
+import threading
+import time
+
+# drops records from the same call site past `rate` per `per` seconds, so that per-vote logging
+# doesn't flood the log during a vote storm. warnings and above always go through.
+# the next record that makes it through gets a count of how many were dropped in the meantime
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate: int = 10, per: float = 60):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self._lock = threading.Lock()
+        self._sites = dict() # (pathname, lineno) -> [window start, records in window, records suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.per:
+                suppressed = site[2] if site else 0
+                site = self._sites[key] = [now, 0, 0]
+            else:
+                suppressed = site[2]
+
+            if site[1] >= self.rate:
+                site[2] += 1
+                return False
+
+            site[1] += 1
+            site[2] = 0
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'process': record.process,
+            'thread': record.threadName,
+            'file': record.filename,
+            'line': record.lineno,
+            'func': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
 
 LOGCONFIG_DICT = {
     'version': 1,
@@ -8,6 +67,16 @@ LOGCONFIG_DICT = {
         'verbose': {
             'format': f'%(asctime)s [%(name)s:%(levelname)s] [%(process)d:%(threadName)s] [%(filename)s:%(lineno)d:%(funcName)s()] %(message)s',
         },
+        'json': {
+            '()': JsonFormatter,
+        },
+    },
+    'filters': {
+        'sampled': {
+            '()': RateLimitFilter,
+            'rate': int(os.getenv('LOG_SAMPLE_RATE', '10')),
+            'per': float(os.getenv('LOG_SAMPLE_PERIOD', '60')),
+        },
     },
     'handlers': {
         'console': {
@@ -16,9 +85,16 @@ LOGCONFIG_DICT = {
         },
         'file': {
             'class': 'logging.FileHandler',
-            'formatter': 'verbose',
+            'formatter': 'json' if os.getenv('LOG_FORMAT') == 'json' else 'verbose',
             'filename': f'{TG_BOT_NAME}.log',
         },
+        # console and file output happen on a background thread (see configure_logging),
+        # so that slow disks or terminals don't block the event loop
+        'queue': {
+            'class': 'logging.handlers.QueueHandler',
+            'handlers': ['console', 'file'],
+            'respect_handler_level': True,
+        },
     },
     'loggers': {
         # `propagate` propagates logs upwards, and is on by default
@@ -26,8 +102,32 @@ LOGCONFIG_DICT = {
         # of course, if we want to log any other logger output to other handlers
         # then we'll need to add a handler for those.
         '': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': os.getenv('LOG_LEVEL_ROOT', 'INFO'),
         },
+        # logs on every vote
+        'bot.poll.models.votes': {
+            'filters': ['sampled'],
+        },
     },
 }
+
+_listener = None
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop() # flushes whatever is still queued up
+        _listener = None
+
+atexit.register(stop_logging)
+
+def configure_logging(config: dict = LOGCONFIG_DICT):
+    global _listener
+    stop_logging()
+    logging.config.dictConfig(config)
+
+    queue_handler = logging.getHandlerByName('queue')
+    if queue_handler is not None and queue_handler.listener is not None:
+        _listener = queue_handler.listener
+        _listener.start()
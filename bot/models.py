@@ -132,3 +132,38 @@ class TelegramChat(Model):
         attrs['last_update'] = round(self.last_update.timestamp())
 
         return f"<TelegramChat({', '.join(f'{k}={v}' for k,v in attrs.items())})>"
+
+# telethon session state, for bot.session.DatabaseStore (TG_SESSION_BACKEND = 'database')
+class TelegramSession(Model):
+    name: str = fields.CharField(max_length=64, pk=True, description="session name (TG_SESSION)")
+    dc_id: int = fields.IntField(null=False, default=0, description="datacenter we're connected to")
+    server_address: str = fields.CharField(max_length=64, null=True, description="address of that datacenter")
+    port: int = fields.IntField(null=True, description="port of that datacenter")
+    auth_key: bytes = fields.BinaryField(null=True, description="auth key for that datacenter")
+    takeout_id: int = fields.BigIntField(null=True, description="takeout session id, if any")
+
+# see telethon.sessions.MemorySession._entity_to_row
+class TelegramSessionEntity(Model):
+    id: int = fields.IntField(pk=True)
+    session: TelegramSession = fields.ForeignKeyField("models.TelegramSession", null=False, on_delete=fields.CASCADE, related_name=False)
+    entity_id: int = fields.BigIntField(null=False, description="marked peer id")
+    hash: int = fields.BigIntField(null=False, description="access hash")
+    username: str = fields.CharField(max_length=64, null=True, description="lowercased @username")
+    phone: str = fields.CharField(max_length=32, null=True, description="phone number")
+    name: str = fields.CharField(max_length=256, null=True, description="display name")
+    date: datetime = fields.DatetimeField(null=False, description="when we last saw this entity change")
+
+    class Meta:
+        unique_together = (("session", "entity_id"),)
+
+class TelegramUpdateState(Model):
+    id: int = fields.IntField(pk=True)
+    session: TelegramSession = fields.ForeignKeyField("models.TelegramSession", null=False, on_delete=fields.CASCADE, related_name=False)
+    entity_id: int = fields.BigIntField(null=False, description="0 for the account itself, otherwise the channel's id")
+    pts: int = fields.IntField(null=False)
+    qts: int = fields.IntField(null=False)
+    date: datetime = fields.DatetimeField(null=False)
+    seq: int = fields.IntField(null=False)
+
+    class Meta:
+        unique_together = (("session", "entity_id"),)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from telethon import utils
+from telethon.tl.types import PeerChannel
+
+from config import POLL__CHANNELS, POLL__THRESHOLD, POLL__LIMIT, POLL__LIMIT_DURATION
+
+logger = logging.getLogger(__name__)
+
+# per-chat poll settings: ChatPollConfig rows (see bot.poll.models) on top of the POLL__* defaults.
+# kept in memory, so that the handlers never have to look anything up; bot.poll.tasks.task_chat_config
+# reloads it whenever the rows' version counter changes, so chats can be added or tuned without a restart
+class ChatSettings:
+    __slots__ = ('threshold', 'limit', 'limit_duration')
+
+    def __init__(self, threshold: int, limit: int, limit_duration: timedelta):
+        self.threshold = threshold
+        self.limit = limit
+        self.limit_duration = limit_duration
+
+defaults = ChatSettings(POLL__THRESHOLD, POLL__LIMIT, POLL__LIMIT_DURATION)
+
+# POLL__CHANNELS as marked chat ids, like telethon's chats=... would have them: unmarked ids are taken to be
+# supergroups (the only kind of chat we run polls in), and usernames and links need looking up, see resolve_channels
+channels: Set[int] = {chat if chat < 0 else utils.get_peer_id(PeerChannel(chat)) for chat in POLL__CHANNELS if isinstance(chat, int)}
+unresolved: List[Union[str, int]] = [chat for chat in POLL__CHANNELS if not isinstance(chat, int)]
+
+# chats we run polls in. always the same set, changed in place, so that event filters can hang on to it
+chats: Set[int] = set(channels)
+
+# chat_id -> settings, for chats that have any of their own
+settings: Dict[int, ChatSettings] = dict()
+
+# (highest version, number of rows) as of the last reload
+version: Optional[Tuple[int, int]] = None
+
+# set once we've loaded, so that handlers don't go by the defaults for a chat that has its own settings
+loaded = asyncio.Event()
+
+def get(chat_id: int) -> ChatSettings:
+    return settings.get(chat_id, defaults)
+
+# for events.NewMessage(func=...) and friends, in place of chats=POLL__CHANNELS. until we've loaded, we can't
+# tell, so everything goes through; handlers wait for `loaded` and then check again
+def in_chats(event) -> bool:
+    return not loaded.is_set() or event.chat_id in chats
+
+# the longest any chat's polls count towards its limit
+def max_limit_duration() -> timedelta:
+    return max((chat.limit_duration for chat in settings.values()), default=defaults.limit_duration)
+
+"""
+looks up the usernames and links in POLL__CHANNELS; anything that can't be looked up right now gets tried again next time
+
+Returns:
+True if anything got added to `channels`
+"""
+async def resolve_channels(client) -> bool:
+    global unresolved
+    still_unresolved: List[Union[str, int]] = []
+    for chat in unresolved:
+        try:
+            chat_id: int = await client.get_peer_id(chat)
+        except Exception as e:
+            logger.warning(f"Couldn't look up {chat!r} in POLL__CHANNELS, will try again later: {e}")
+            still_unresolved.append(chat)
+            continue
+
+        logger.info(f"{chat!r} in POLL__CHANNELS is {chat_id}")
+        channels.add(chat_id)
+
+    added: bool = len(still_unresolved) < len(unresolved)
+    unresolved = still_unresolved
+    return added
+
+"""
+replaces what we've got with `rows` (every ChatPollConfig there is)
+"""
+def apply(rows: Iterable, new_version: Tuple[int, int]):
+    global version
+    new_chats: Set[int] = set(channels)
+    new_settings: Dict[int, ChatSettings] = dict()
+    for row in rows:
+        if row.enabled:
+            new_chats.add(row.chat_id)
+        else:
+            new_chats.discard(row.chat_id)
+
+        new_settings[row.chat_id] = ChatSettings(
+            row.threshold if row.threshold is not None else defaults.threshold,
+            row.limit if row.limit is not None else defaults.limit,
+            row.limit_duration if row.limit_duration is not None else defaults.limit_duration,
+        )
+
+    added: Set[int] = new_chats - chats
+    removed: Set[int] = chats - new_chats
+    chats.difference_update(removed)
+    chats.update(added)
+    settings.clear()
+    settings.update(new_settings)
+    version = new_version
+    loaded.set()
+
+    logger.info(f"Loaded poll settings for {len(settings)} chats, polls enabled in {len(chats)}" + (f" (added {sorted(added)}, removed {sorted(removed)})" if added or removed else ''))
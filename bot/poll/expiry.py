@@ -0,0 +1,108 @@
+import asyncio
+import heapq
+import logging
+import uuid
+import pytz
+
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from tortoise.functions import Count
+from tortoise.transactions import in_transaction
+
+from bot.poll import reputation, status
+from bot.poll.models import Poll, Vote, VoteChoice
+from config import POLL__LIFETIME
+
+logger = logging.getLogger(__name__)
+
+# (deadline timestamp, poll_id) of every active poll, earliest first.
+# bot.poll.tasks.task_poll_expiry sleeps until the first deadline and expires everything that's due
+deadlines: List[Tuple[float, uuid.UUID]] = []
+
+# set whenever a poll gets a deadline earlier than the ones we're already waiting for
+wakeup = asyncio.Event()
+
+# (chat_id, poll_msg_id, poll, counts) of expired polls whose messages still need editing
+pending_edits: asyncio.Queue = asyncio.Queue()
+
+def schedule(poll: Poll):
+    if POLL__LIFETIME is None:
+        return
+
+    deadline: float = (poll.timestamp + POLL__LIFETIME).timestamp()
+    heapq.heappush(deadlines, (deadline, poll.poll_id))
+    if deadlines[0][1] == poll.poll_id:
+        wakeup.set()
+
+def next_deadline() -> Optional[float]:
+    return deadlines[0][0] if deadlines else None
+
+async def load():
+    if POLL__LIFETIME is None:
+        return
+
+    active: List[Tuple[uuid.UUID, datetime]] = await Poll.filter(ended=False).values_list('poll_id', 'timestamp')
+    deadlines.extend(((timestamp + POLL__LIFETIME).timestamp(), poll_id) for poll_id, timestamp in active)
+    heapq.heapify(deadlines)
+    logger.info(f"Loaded deadlines for {len(active)} active polls")
+
+"""
+ends whichever of `poll_ids` are still running, and queues up their messages for editing. polls that already have
+a winner are left alone: a vote got in just before we got to them, and bob_votes deals with those like any other win
+
+Returns:
+the polls that got expired
+"""
+async def expire(poll_ids: List[uuid.UUID]) -> List[Poll]:
+    # one transaction, so that nothing can end one of these between us looking at it and ending it
+    async with in_transaction():
+        polls: List[Poll] = await Poll.filter(poll_id__in=poll_ids, ended=False).prefetch_related('source', 'target', 'chat')
+        if not polls:
+            return []
+
+        counts: Dict[uuid.UUID, Dict[VoteChoice, int]] = {poll.poll_id: dict() for poll in polls}
+        for row in await Vote.filter(poll_id__in=list(counts)).annotate(count=Count('vote_id')).group_by('poll_id', 'choice').values('poll_id', 'choice', 'count'):
+            counts[row['poll_id']][row['choice']] = row['count']
+
+        polls = [poll for poll in polls if poll.get_winner(counts[poll.poll_id]) is None]
+        if polls:
+            await Poll.filter(poll_id__in=[poll.poll_id for poll in polls]).update(ended=True)
+
+    for poll in polls:
+        poll.ended = True
+        reputation.record_outcome(poll, None)
+        status.ended(poll, counts[poll.poll_id], 'expired')
+        if poll.poll_msg_id is not None:
+            pending_edits.put_nowait((poll.chat_id, poll.poll_msg_id, poll, counts[poll.poll_id]))
+
+    return polls
+
+"""
+expires up to `batch_size` polls whose deadline has passed, see expire
+
+Returns:
+number of deadlines that were due; anything less than batch_size means we're done for now
+"""
+async def expire_due(batch_size: int, now: Optional[float] = None) -> int:
+    now = now or datetime.now(tz=pytz.utc).timestamp()
+
+    due: List[uuid.UUID] = []
+    while deadlines and deadlines[0][0] <= now and len(due) < batch_size:
+        due.append(heapq.heappop(deadlines)[1])
+
+    if not due:
+        return 0
+
+    try:
+        # some of these will have ended on their own by now
+        polls: List[Poll] = await expire(due)
+    except Exception:
+        # put them back, so that we try again next time
+        for poll_id in due:
+            heapq.heappush(deadlines, (now, poll_id))
+        raise
+
+    if polls:
+        logger.info(f"Expired {len(polls)} polls")
+    return len(due)
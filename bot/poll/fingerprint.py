@@ -0,0 +1,176 @@
+import logging
+import random
+import re
+import unicodedata
+import zlib
+
+from array import array
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from telethon.tl.types import Message, MessageEntityUrl, MessageEntityTextUrl
+
+from bot.poll.models import FingerprintKind, Poll, ScamFingerprint
+from config import POLL__FINGERPRINT_SIMILARITY, POLL__FINGERPRINT_IGNORED_DOMAINS
+
+logger = logging.getLogger(__name__)
+
+# fingerprints of messages that led to a successful ban, so that reposts of the same scam
+# can be caught as soon as they're posted. two kinds:
+# - hashes of the urls in the message, matched exactly. only urls that point somewhere in particular count
+#   (see is_generic), or the first scam to mention google.com would get everyone else who does banned too
+# - a minhash signature of the message's word shingles, matched by estimated jaccard similarity,
+#   with LSH banding so that we only ever compare against a handful of candidates. shingles are short and
+#   signatures long, so that swapping out a word or two (a greeting, "today" for "now") doesn't get a repost
+#   past us: that typically still leaves a similarity of 0.6-0.8, where unrelated messages come in under 0.1.
+#   32 bands of 4 rows make anything over ~0.5 all but certain to end up a candidate
+
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 2
+MIN_WORDS = 8 # anything shorter is too generic to match on
+PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+_rng = random.Random(0x5CA3) # fixed seed: signatures are persisted, so the permutations can't change
+PERMUTATIONS: List[Tuple[int, int]] = [(_rng.randrange(1, PRIME), _rng.randrange(0, PRIME)) for _ in range(NUM_PERM)]
+
+regex_url = re.compile(r'(?:https?://|www\.|\bt\.me/)\S+', re.I)
+TELEGRAM_HOSTS = {'t.me', 'telegram.me', 'telegram.dog'}
+IGNORED_DOMAINS = {domain.casefold() for domain in POLL__FINGERPRINT_IGNORED_DOMAINS}
+regex_word = re.compile(r'\w+')
+ZERO_WIDTH = dict.fromkeys(map(ord, '\u200b\u200c\u200d\u2060\ufeff'))
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize('NFKC', text).translate(ZERO_WIDTH).casefold()
+
+def normalize_url(url: str) -> str:
+    url = normalize_text(url).rstrip('/.,!?)')
+    url = re.sub(r'^(?:https?://)?(?:www\.)?', '', url)
+    return url
+
+def hash_url(url: str) -> bytes:
+    return blake2b(normalize_url(url).encode('utf-8'), digest_size=8).digest()
+
+"""
+whether `url` is too common to say anything about the message it's in: a bare domain, anything on
+POLL__FINGERPRINT_IGNORED_DOMAINS, or a link to the chat itself (`own_usernames`, lowercase)
+"""
+def is_generic(url: str, own_usernames: Set[str]) -> bool:
+    host, _, path = normalize_url(url).partition('/')
+    host = host.rsplit('@', 1)[-1].split(':', 1)[0]
+    path = path.split('?', 1)[0].split('#', 1)[0].strip('/')
+    if not path:
+        return True
+
+    if any(host == domain or host.endswith(f'.{domain}') for domain in IGNORED_DOMAINS):
+        return True
+
+    return host in TELEGRAM_HOSTS and path.split('/', 1)[0] in own_usernames
+
+"""
+returns the urls in `msg` that are worth fingerprinting, see is_generic
+"""
+def get_urls(msg: Message) -> List[str]:
+    urls: List[str] = []
+    for ent, txt in msg.get_entities_text():
+        if isinstance(ent, MessageEntityUrl):
+            urls.append(txt)
+        elif isinstance(ent, MessageEntityTextUrl):
+            urls.append(ent.url)
+
+    # telegram doesn't always give us entities (e.g. for t.me links without a scheme)
+    if not urls and msg.message:
+        urls = regex_url.findall(msg.message)
+
+    # basic groups don't have usernames, and channels can have more than one
+    own_usernames: Set[str] = {u.username.casefold() for u in getattr(msg.chat, 'usernames', None) or ()}
+    if getattr(msg.chat, 'username', None):
+        own_usernames.add(msg.chat.username.casefold())
+    return [url for url in urls if not is_generic(url, own_usernames)]
+
+def minhash(text: str) -> Optional[array]:
+    words: List[str] = regex_word.findall(normalize_text(regex_url.sub(' ', text)))
+    if len(words) < MIN_WORDS:
+        return None
+
+    shingles: Set[int] = {zlib.crc32(' '.join(words[i:i + SHINGLE_SIZE]).encode('utf-8')) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return array('I', (min(((a * x + b) % PRIME) & MAX_HASH for x in shingles) for a, b in PERMUTATIONS))
+
+def band_keys(sig: array) -> List[Tuple[int, ...]]:
+    return [(band,) + tuple(sig[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS)]
+
+class FingerprintIndex:
+    def __init__(self):
+        self.urls: Dict[bytes, int] = dict() # url hash -> fingerprint id
+        self.signatures: Dict[int, array] = dict() # fingerprint id -> minhash signature
+        self.bands: Dict[Tuple[int, ...], Set[int]] = dict() # band key -> fingerprint ids
+
+    def __len__(self) -> int:
+        return len(self.urls) + len(self.signatures)
+
+    def add(self, fingerprint: ScamFingerprint):
+        if fingerprint.kind == FingerprintKind.URL:
+            self.urls[bytes(fingerprint.value)] = fingerprint.id
+        elif fingerprint.kind == FingerprintKind.MINHASH: # MINHASH_4WORD signatures can't be compared with these
+            sig: array = array('I')
+            sig.frombytes(fingerprint.value)
+            self.signatures[fingerprint.id] = sig
+            for key in band_keys(sig):
+                self.bands.setdefault(key, set()).add(fingerprint.id)
+
+    """
+    returns the id of the first fingerprint that matches, or None
+    """
+    def match(self, text: str, urls: Iterable[str]) -> Optional[int]:
+        for url in urls:
+            fp_id: Optional[int] = self.urls.get(hash_url(url))
+            if fp_id is not None:
+                return fp_id
+
+        if not self.signatures:
+            return None
+
+        sig: Optional[array] = minhash(text)
+        if sig is None:
+            return None
+
+        candidates: Set[int] = set()
+        for key in band_keys(sig):
+            candidates |= self.bands.get(key, set())
+
+        for fp_id in candidates:
+            other: array = self.signatures[fp_id]
+            similarity: float = sum(1 for x, y in zip(sig, other) if x == y) / NUM_PERM
+            if similarity >= POLL__FINGERPRINT_SIMILARITY:
+                return fp_id
+
+        return None
+
+index = FingerprintIndex()
+
+async def load():
+    async for fingerprint in ScamFingerprint.filter(kind__not=FingerprintKind.MINHASH_4WORD):
+        index.add(fingerprint)
+    logger.info(f"Loaded {len(index)} scam fingerprints")
+
+"""
+fingerprints `msg`, which got its sender banned by `poll`
+"""
+async def record(poll: Poll, msg: Message):
+    fingerprints: List[ScamFingerprint] = [
+        ScamFingerprint(kind=FingerprintKind.URL, value=url_hash, chat_id=poll.chat_id, poll_id=poll.poll_id)
+        for url_hash in {hash_url(url) for url in get_urls(msg)} if url_hash not in index.urls
+    ]
+
+    sig: Optional[array] = minhash(msg.message or '')
+    if sig is not None and index.match(msg.message, ()) is None:
+        fingerprints.append(ScamFingerprint(kind=FingerprintKind.MINHASH, value=sig.tobytes(), chat_id=poll.chat_id, poll_id=poll.poll_id))
+
+    for fingerprint in fingerprints:
+        await fingerprint.save()
+        index.add(fingerprint)
+
+    if fingerprints:
+        logger.info(f"Added {len(fingerprints)} scam fingerprints from poll {poll.poll_id}")
@@ -5,7 +5,7 @@ import pytz
 
 from enum import IntEnum
 from datetime import datetime
-from typing import AsyncIterator, Iterable, List, Optional, Dict, Union
+from typing import AsyncIterator, Iterable, List, Optional, Dict, Tuple, Union
 
 from telethon import TelegramClient
 from telethon.hints import Entity
@@ -15,13 +15,16 @@ from tortoise import fields
 from tortoise.models import Model
 from tortoise.exceptions import DoesNotExist, MultipleObjectsReturned
 from tortoise.queryset import QuerySet
-from tortoise.functions import Count
+from tortoise.functions import Count, Max
+from tortoise.transactions import in_transaction
 
 from bot.models import TelegramUser, TelegramChat
+from bot.poll import chatconfig
 
-from config import POLL__LIMIT, POLL__LIMIT_DURATION, POLL__THRESHOLD
+from config import POLL__LIFETIME
 
 logger = logging.getLogger(__name__)
+vote_logger = logging.getLogger(f'{__name__}.votes') # logs on every vote, so it gets sampled (see bot.logconfig)
 
 class PollType(IntEnum):
     BAN = 1
@@ -30,6 +33,17 @@ class VoteChoice(IntEnum):
     YES = 1
     NO = 2
 
+class PropagationStatus(IntEnum):
+    PENDING = 1
+    BANNED = 2
+    NOT_PARTICIPANT = 3 # nothing to do, user isn't in that chat
+    FAILED = 4
+
+class FingerprintKind(IntEnum):
+    URL = 1 # 8-byte hash of a normalized url
+    MINHASH_4WORD = 2 # minhash signature of 4-word shingles, too easy to get around. no longer made or matched
+    MINHASH = 3 # minhash signature of the message text
+
 class Poll(Model):
     poll_id: uuid.UUID = fields.UUIDField(pk=True, default=uuid.uuid4, description="Unique poll id")
     timestamp: datetime = fields.DatetimeField(null=False, auto_now_add=True, description="Time of poll")
@@ -41,12 +55,14 @@ class Poll(Model):
     forced: bool = fields.BooleanField(null=False, default=False, description="was this poll forced, e.g. started by an admin?")
     msg_id: int = fields.IntField(null=True, description="message ID that bob was called on")
     poll_msg_id: int = fields.IntField(null=True, description="msg id of poll message")
+    threshold: int = fields.IntField(null=True, description="number of votes before we process an action, as of when the poll was started")
 
     @classmethod
     async def poll_limit_reached(cls, chat: TelegramChat, poll_type: PollType = PollType.BAN, timestamp: datetime = None) -> bool:
-        duration_start: datetime = (timestamp or datetime.now(tz=pytz.utc)) - POLL__LIMIT_DURATION
+        settings: chatconfig.ChatSettings = chatconfig.get(chat.chat_id)
+        duration_start: datetime = (timestamp or datetime.now(tz=pytz.utc)) - settings.limit_duration
         count: int = await Poll.filter(chat=chat, poll_type=poll_type, timestamp__gt=duration_start, forced=False).count()
-        return count >= POLL__LIMIT
+        return count >= settings.limit
     
     
     @classmethod
@@ -64,9 +80,11 @@ class Poll(Model):
 
     """
     throws PollLimitReached
+
+    with create=False, returns (False, None) instead of starting a new poll if there's no active one
     """
     @classmethod
-    async def get_poll(cls, chat: TelegramChat, target: TelegramUser, source: TelegramUser, msg_id: int = None, poll_type: PollType = PollType.BAN, force: bool = False): # returns (already_exists: bool, Poll)
+    async def get_poll(cls, chat: TelegramChat, target: TelegramUser, source: TelegramUser, msg_id: int = None, poll_type: PollType = PollType.BAN, force: bool = False, create: bool = True): # returns (already_exists: bool, Poll)
         poll: Optional[Poll] = None
         try:
             poll = await Poll.get(chat=chat, target=target, poll_type=poll_type, ended=False)
@@ -94,8 +112,19 @@ class Poll(Model):
 
         # if we got a suitable Poll instance
         if poll is not None:
-            # but it's already finished...
-            if await poll.vote_winner() is not None:
+            # but it's run out of time (and task_poll_expiry hasn't got to it yet)...
+            if poll.is_expired():
+                # it imports this module
+                from bot.poll import expiry
+
+                # same as if task_poll_expiry had got to it first, so that its message gets edited too
+                if not await expiry.expire([poll.poll_id]):
+                    # it got a winner just before it ran out, so it only needs ending, like below
+                    await Poll.filter(poll_id=poll.poll_id).update(ended=True)
+                logger.warning(f"Got a poll {poll} that has already expired, let's try again")
+                poll = None
+            # or it's already finished...
+            elif await poll.vote_winner() is not None:
                 poll.ended = True
                 await poll.save()
                 logger.warning(f"Got a poll {poll} that has already ended, let's try again")
@@ -109,16 +138,27 @@ class Poll(Model):
         # note that this can't be an else branch
         # because we set poll = None if the poll instance we got is unsuitable
         if poll is None:
+            if not create:
+                return (False, None)
+
             timestamp: datetime = datetime.now(tz=pytz.utc)
             limit_reached: bool = await Poll.poll_limit_reached(chat, poll_type, timestamp)
             if limit_reached:
                 raise PollLimitReached(chat, poll_type, timestamp)
 
-            poll: Poll = Poll(poll_type=poll_type, chat=chat, source=source, target=target, msg_id=msg_id)
+            poll: Poll = Poll(poll_type=poll_type, chat=chat, source=source, target=target, msg_id=msg_id, threshold=chatconfig.get(chat.chat_id).threshold)
             await poll.save()
             logger.info(f"Created new poll {poll.poll_id} in {chat}, type {poll_type}, source {source}, target {target}")
             return (False, poll)
 
+    # so that changing a chat's threshold doesn't change the outcome of polls that are already running (or over).
+    # polls from before we kept track of this go by the chat's current threshold
+    def get_threshold(self) -> int:
+        return self.threshold if self.threshold is not None else chatconfig.get(self.chat_id).threshold
+
+    def is_expired(self, now: datetime = None) -> bool:
+        return POLL__LIFETIME is not None and (now or datetime.now(tz=pytz.utc)) - self.timestamp > POLL__LIFETIME
+
     async def set_poll_msg_id(self, poll_msg_id: int):
         self.poll_msg_id = poll_msg_id
         await self.save()
@@ -132,47 +172,65 @@ class Poll(Model):
     returns true if changed, false otherwise
     """
     async def vote(self, user: TelegramUser, choice: VoteChoice) -> bool:
-        await self.refresh_from_db() # try to avoid races?
-        if self.ended:
-            return True # fail fast
+        changed, _ = await self.vote_many([(user, choice)])
+        return changed
 
-        try:
-            vote: Vote = await Vote.get(poll=self, user=user)
-            if vote.choice == choice:
-                return False
-            new: bool = False
-        except MultipleObjectsReturned:
-            logger.exception("Uh oh, we somehow got multiple objects for this!")
-            raise
-        except DoesNotExist:
-            vote: Vote = Vote(poll=self, user=user)
-            new: bool = True
-        
-        # at this point, we've either got an existing vote that needs to be changed
-        # or a new vote
+    """
+    applies several votes at once, in order, stopping once a choice reaches the threshold: one query for the votes
+    that are already in, one write per kind of change, and one tally afterwards
 
-        # well, if it's an old vote, let this vote go through first
+    Returns:
+    (true if anything changed, the tally as of afterwards)
+    """
+    async def vote_many(self, votes: List[Tuple[TelegramUser, VoteChoice]]) -> Tuple[bool, Dict[VoteChoice, int]]:
+        await self.refresh_from_db(fields=['ended']) # try to avoid races?
+        existing: Dict[int, Vote] = {vote.user_id: vote for vote in await Vote.filter(poll=self)}
+        stats: Dict[VoteChoice, int] = dict()
+        for vote in existing.values():
+            stats[vote.choice] = stats.get(vote.choice, 0) + 1
 
-        if not new:
-            vote.choice = choice
-            await vote.save()
-            logger.info(f"Updating vote choice to {choice} for vote id {vote.vote_id}")
-        
-        if await self.vote_winner() is not None:
+        if self.ended:
+            return True, stats # fail fast
+
+        to_create: Dict[int, Vote] = dict()
+        to_update: Dict[int, Vote] = dict()
+        for user, choice in votes:
+            if self.get_winner(stats) is not None:
+                break # anything after this doesn't count
+
+            vote: Optional[Vote] = existing.get(user.user_id)
+            if vote is None:
+                vote = existing[user.user_id] = to_create[user.user_id] = Vote(poll=self, user=user, choice=choice)
+            elif vote.choice == choice:
+                continue
+            else:
+                stats[vote.choice] -= 1
+                vote.choice = choice
+                if user.user_id not in to_create:
+                    to_update[user.user_id] = vote
+            stats[choice] = stats.get(choice, 0) + 1
+
+        if not to_create and not to_update:
+            return False, stats
+
+        if to_create:
+            await Vote.bulk_create(list(to_create.values()))
+        if to_update:
+            await Vote.bulk_update(list(to_update.values()), fields=['choice'])
+        for vote in to_create.values():
+            vote_logger.info("Creating new vote by %s for %s on poll %s with vote id %s", vote.user_id, vote.choice, self.poll_id, vote.vote_id)
+        for vote in to_update.values():
+            vote_logger.info("Updating vote choice to %s for vote id %s", vote.choice, vote.vote_id)
+
+        # again, since others might've voted in the meantime
+        stats = await self.get_vote_stats()
+        if self.get_winner(stats) is not None:
             self.ended = True
-            await self.save()
-            logger.info(f"Poll finished for {self.poll_id}")
-        elif new: # since we handled the thingamajig for !new
-            vote.choice = choice
-            await vote.save()
-            logger.info(f"Creating new vote by {user} for {choice} on poll {self.poll_id} with vote id {vote.vote_id}")
-            if await self.vote_winner() is not None: # oh?
-                self.ended = True
-                await self.save()
-                logger.info(f"Poll finished for {self.poll_id}")
-        
-        return True
-    
+            await self.save(update_fields=['ended'])
+            logger.info("Poll finished for %s", self.poll_id)
+
+        return True, stats
+
     async def get_vote_stats(self) -> Dict[VoteChoice, int]:
         ret = dict()
 
@@ -185,9 +243,12 @@ class Poll(Model):
         return ret
     
     async def vote_winner(self) -> Optional[VoteChoice]:
-        stats: Dict[VoteChoice, int] = await self.get_vote_stats()
+        return self.get_winner(await self.get_vote_stats())
+
+    def get_winner(self, stats: Dict[VoteChoice, int]) -> Optional[VoteChoice]:
+        threshold: int = self.get_threshold()
         for choice, count in stats.items():
-            if count >= POLL__THRESHOLD:
+            if count >= threshold:
                 return choice
 
         return None
@@ -239,3 +300,116 @@ class Vote(Model):
     class Meta:
         # compound index for the components that make up `key`
         unique_together = (("poll", "user"),)
+
+# per-chat overrides of POLL__THRESHOLD, POLL__LIMIT and POLL__LIMIT_DURATION (null means the default),
+# and whether polls run in that chat at all. kept in memory by bot.poll.chatconfig; change rows through put,
+# so that the version goes up and running bots pick up the change
+class ChatPollConfig(Model):
+    chat_id: int = fields.IntField(pk=True, description="chat these settings apply to")
+    enabled: bool = fields.BooleanField(null=False, default=True, description="do we run polls in this chat?")
+    threshold: int = fields.IntField(null=True, description="number of votes before we process an action")
+    limit: int = fields.IntField(null=True, description="maximum number of polls allowed in limit_duration")
+    limit_duration = fields.TimeDeltaField(null=True, description="see limit")
+    version: int = fields.IntField(null=False, default=0, description="bumped on every change")
+
+    """
+    Returns:
+    (highest version, number of rows); changes whenever a row is added, changed or deleted
+    """
+    @classmethod
+    async def current_version(cls) -> Tuple[int, int]:
+        row: Dict[str, Optional[int]] = (await cls.annotate(max_version=Max('version'), count=Count('chat_id')).values('max_version', 'count'))[0]
+        return row['max_version'] or 0, row['count']
+
+    """
+    loads every row into bot.poll.chatconfig, unless nothing's changed since the last time
+
+    Returns:
+    True if anything was loaded
+    """
+    @classmethod
+    async def reload(cls, force: bool = False) -> bool:
+        version: Tuple[int, int] = await cls.current_version()
+        if not force and version == chatconfig.version:
+            return False
+
+        chatconfig.apply(await cls.all(), version)
+        return True
+
+    """
+    creates or changes the settings for a chat
+
+    Arguments:
+    - chat_id (int): chat to change the settings for
+    - changes: any of enabled, threshold, limit and limit_duration (None to go back to the default)
+    """
+    @classmethod
+    async def put(cls, chat_id: int, **changes) -> 'ChatPollConfig':
+        async with in_transaction():
+            version, _ = await cls.current_version()
+            row, _ = await cls.get_or_create(chat_id=chat_id)
+            for field, value in changes.items():
+                setattr(row, field, value)
+            row.version = version + 1
+            await row.save()
+        logger.info(f"Changed poll settings for {chat_id}: {changes}")
+        return row
+
+# persisted copy of the in-memory reputation index in bot.poll.reputation
+class UserReputation(Model):
+    id: int = fields.IntField(pk=True)
+    chat: TelegramChat = fields.ForeignKeyField("models.TelegramChat", null=False, on_delete=fields.RESTRICT, related_name=False, description="chat this reputation applies to")
+    user: TelegramUser = fields.ForeignKeyField("models.TelegramUser", null=False, on_delete=fields.RESTRICT, related_name=False, description="user this reputation applies to")
+    initiated: int = fields.IntField(null=False, default=0, description="number of polls started by this user")
+    succeeded: int = fields.IntField(null=False, default=0, description="number of polls started by this user that ended with a yes")
+    failed: int = fields.IntField(null=False, default=0, description="number of polls started by this user that ended with a no")
+    cleared_at: datetime = fields.DatetimeField(null=True, description="last time a poll against this user ended with a no")
+
+    class Meta:
+        unique_together = (("chat", "user"),)
+
+# users banned by a poll, shared across all the chats we run polls in
+class BannedUser(Model):
+    id: int = fields.IntField(pk=True)
+    user: TelegramUser = fields.ForeignKeyField("models.TelegramUser", null=False, unique=True, on_delete=fields.RESTRICT, related_name=False, description="banned user")
+    chat: TelegramChat = fields.ForeignKeyField("models.TelegramChat", null=False, on_delete=fields.RESTRICT, related_name=False, description="chat in which the user was first banned")
+    poll_id: uuid.UUID = fields.UUIDField(null=True, description="poll that banned the user")
+    timestamp: datetime = fields.DatetimeField(null=False, auto_now_add=True, description="Time of ban")
+
+    """
+    Adds the target of a poll to the ban list, and queues up a BanPropagation for every other chat in `chat_ids`
+
+    Returns:
+    True if the user wasn't on the ban list yet, False otherwise
+    """
+    @classmethod
+    async def add_from_poll(cls, poll: Poll, chat_ids: Iterable[int]) -> bool:
+        ban, created = await BannedUser.get_or_create(user_id=poll.target_id, defaults={"chat_id": poll.chat_id, "poll_id": poll.poll_id})
+        if not created:
+            return False
+
+        rows: List[BanPropagation] = [BanPropagation(ban=ban, chat_id=chat_id) for chat_id in chat_ids if chat_id != poll.chat_id]
+        if rows: # tortoise still sends a query for an empty list
+            await BanPropagation.bulk_create(rows)
+        logger.info(f"Added user {poll.target_id} to the ban list from poll {poll.poll_id}")
+        return True
+
+# progress of applying a BannedUser to one other chat
+class BanPropagation(Model):
+    id: int = fields.IntField(pk=True)
+    ban: BannedUser = fields.ForeignKeyField("models.BannedUser", null=False, on_delete=fields.CASCADE, related_name="propagations")
+    chat_id: int = fields.IntField(null=False, description="chat to apply the ban to")
+    status: PropagationStatus = fields.IntEnumField(enum_type=PropagationStatus, null=False, default=PropagationStatus.PENDING, description="has the ban been applied yet?")
+    timestamp: datetime = fields.DatetimeField(null=False, auto_now=True, description="Time of last status change")
+
+    class Meta:
+        unique_together = (("ban", "chat_id"),)
+
+# fingerprints of messages that got their sender banned, see bot.poll.fingerprint
+class ScamFingerprint(Model):
+    id: int = fields.IntField(pk=True)
+    kind: FingerprintKind = fields.IntEnumField(enum_type=FingerprintKind, null=False, description="type of fingerprint")
+    value: bytes = fields.BinaryField(null=False, description="the fingerprint itself")
+    chat: TelegramChat = fields.ForeignKeyField("models.TelegramChat", null=False, on_delete=fields.RESTRICT, related_name=False, description="chat the message was posted in")
+    poll_id: uuid.UUID = fields.UUIDField(null=True, description="poll that banned the sender")
+    timestamp: datetime = fields.DatetimeField(null=False, auto_now_add=True, description="Time of fingerprinting")
@@ -0,0 +1,21 @@
+import asyncio
+import logging
+
+from bot.poll import chatconfig
+from bot.poll.models import BannedUser, Poll
+from config import POLL__PROPAGATE_BANS
+
+logger = logging.getLogger(__name__)
+
+# set whenever there's something new for bot.poll.tasks.task_ban_propagation to do
+wakeup = asyncio.Event()
+
+async def queue_ban(poll: Poll):
+    if not POLL__PROPAGATE_BANS:
+        return
+
+    try:
+        if await BannedUser.add_from_poll(poll, chatconfig.chats):
+            wakeup.set()
+    except Exception:
+        logger.exception(f"Got exception while adding the target of {poll.poll_id} to the ban list")
@@ -0,0 +1,157 @@
+import logging
+import pytz
+
+from collections import deque
+from datetime import datetime
+from time import time
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+import cachetools
+
+from bot.poll.models import Poll, UserReputation, VoteChoice
+from config import POLL__ABUSE_MAX_POLLS, POLL__ABUSE_WINDOW, POLL__ABUSE_MIN_DECIDED, POLL__ABUSE_MIN_SUCCESS_RATIO, POLL__CLEARED_COOLDOWN
+
+logger = logging.getLogger(__name__)
+
+# per-(chat, user) poll history, kept in memory so that handler_bob can turn away
+# serial abusers and redundant polls without touching the database or telegram.
+# bot.poll.tasks.task_reputation loads this on startup and flushes it periodically
+class Reputation:
+    __slots__ = ('initiated', 'succeeded', 'failed', 'cleared_at', 'recent')
+
+    def __init__(self, initiated: int = 0, succeeded: int = 0, failed: int = 0, cleared_at: Optional[float] = None):
+        self.initiated: int = initiated
+        self.succeeded: int = succeeded
+        self.failed: int = failed
+        self.cleared_at: Optional[float] = cleared_at
+        self.recent: Deque[float] = deque() # start times of polls in the past POLL__ABUSE_WINDOW, not persisted
+
+    def recent_count(self, now: float) -> int:
+        window_start: float = now - POLL__ABUSE_WINDOW.total_seconds()
+        while self.recent and self.recent[0] <= window_start:
+            self.recent.popleft()
+        return len(self.recent)
+
+reputations: Dict[Tuple[int, int], Reputation] = dict()
+dirty: Set[Tuple[int, int]] = set()
+
+# polls whose outcome we've already counted -- bob_vote can run more than once on an ended poll
+recorded_polls = cachetools.TTLCache(maxsize=1024, ttl=60*60)
+
+def get_reputation(chat_id: int, user_id: int) -> Reputation:
+    key: Tuple[int, int] = (chat_id, user_id)
+    rep: Optional[Reputation] = reputations.get(key)
+    if rep is None:
+        rep = reputations[key] = Reputation()
+    return rep
+
+"""
+returns the reason why user_id shouldn't be allowed to start a poll in chat_id, or None if they're fine
+"""
+def check_source(chat_id: int, user_id: int, now: Optional[float] = None) -> Optional[str]:
+    rep: Optional[Reputation] = reputations.get((chat_id, user_id))
+    if rep is None:
+        return None
+
+    if rep.recent_count(now or time()) >= POLL__ABUSE_MAX_POLLS:
+        return "You've started too many polls recently. Please contact an admin instead."
+
+    decided: int = rep.succeeded + rep.failed
+    if decided >= POLL__ABUSE_MIN_DECIDED and rep.succeeded / decided < POLL__ABUSE_MIN_SUCCESS_RATIO:
+        return "Most of the polls you've started didn't pass. Please contact an admin instead."
+
+    return None
+
+"""
+returns the reason why user_id shouldn't be the target of a new poll in chat_id, or None if they're fine
+"""
+def check_target(chat_id: int, user_id: int, now: Optional[float] = None) -> Optional[str]:
+    rep: Optional[Reputation] = reputations.get((chat_id, user_id))
+    if rep is None or rep.cleared_at is None:
+        return None
+
+    if (now or time()) - rep.cleared_at < POLL__CLEARED_COOLDOWN.total_seconds():
+        return "The community has recently decided not to ban this user. Please contact an admin instead."
+
+    return None
+
+def record_initiation(chat_id: int, user_id: int, now: Optional[float] = None):
+    rep: Reputation = get_reputation(chat_id, user_id)
+    rep.initiated += 1
+    rep.recent.append(now or time())
+    dirty.add((chat_id, user_id))
+
+def record_outcome(poll: Poll, outcome: Optional[VoteChoice], now: Optional[float] = None):
+    if poll.poll_id in recorded_polls:
+        return
+    recorded_polls[poll.poll_id] = True
+
+    source: Reputation = get_reputation(poll.chat_id, poll.source_id)
+    if outcome == VoteChoice.YES:
+        source.succeeded += 1
+    elif outcome == VoteChoice.NO:
+        source.failed += 1
+        target: Reputation = get_reputation(poll.chat_id, poll.target_id)
+        target.cleared_at = now or time()
+        dirty.add((poll.chat_id, poll.target_id))
+    dirty.add((poll.chat_id, poll.source_id))
+
+async def load():
+    async for row in UserReputation.all():
+        reputations[(row.chat_id, row.user_id)] = Reputation(
+            initiated=row.initiated,
+            succeeded=row.succeeded,
+            failed=row.failed,
+            cleared_at=row.cleared_at.timestamp() if row.cleared_at else None,
+        )
+
+    # the sliding window isn't persisted, but the poll table has everything we need for it
+    window_start: datetime = datetime.now(tz=pytz.utc) - POLL__ABUSE_WINDOW
+    recent: List[Tuple[int, int, datetime]] = await Poll.filter(timestamp__gt=window_start, forced=False).order_by('timestamp').values_list('chat_id', 'source_id', 'timestamp')
+    for chat_id, source_id, timestamp in recent:
+        get_reputation(chat_id, source_id).recent.append(timestamp.timestamp())
+
+    logger.info(f"Loaded {len(reputations)} reputations")
+
+async def flush():
+    if not dirty:
+        return
+
+    keys: List[Tuple[int, int]] = list(dirty)
+    dirty.clear()
+
+    try:
+        existing: Dict[Tuple[int, int], UserReputation] = {
+            (row.chat_id, row.user_id): row
+            async for row in UserReputation.filter(
+                chat_id__in={key[0] for key in keys},
+                user_id__in={key[1] for key in keys},
+            )
+        }
+
+        to_create: List[UserReputation] = []
+        to_update: List[UserReputation] = []
+        for key in keys:
+            rep: Reputation = reputations[key]
+            row: Optional[UserReputation] = existing.get(key)
+            if row is None:
+                row = UserReputation(chat_id=key[0], user_id=key[1])
+                to_create.append(row)
+            else:
+                to_update.append(row)
+
+            row.initiated = rep.initiated
+            row.succeeded = rep.succeeded
+            row.failed = rep.failed
+            row.cleared_at = datetime.fromtimestamp(rep.cleared_at, tz=pytz.utc) if rep.cleared_at else None
+
+        if to_create:
+            await UserReputation.bulk_create(to_create)
+        if to_update:
+            await UserReputation.bulk_update(to_update, fields=['initiated', 'succeeded', 'failed', 'cleared_at'])
+    except Exception:
+        # try again next time
+        dirty.update(keys)
+        raise
+
+    logger.info(f"Flushed {len(keys)} reputations")
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import logging
+import pytz
+import uuid
+
+from collections import deque
+from datetime import datetime
+from time import monotonic, time
+from typing import Deque, Dict, List, Optional, Tuple
+
+import cachetools
+from tortoise.functions import Count
+
+from bot.poll import chatconfig
+from bot.poll.models import Poll, PollType, Vote, VoteChoice
+from config import POLL__LIFETIME, POLL__STATUS_RECENT
+
+logger = logging.getLogger(__name__)
+
+# what the status endpoint (see serve) answers from, so that whoever's watching it never costs us a query.
+# loaded once on startup by bot.poll.tasks.task_status, and kept up to date by the handlers and the expiry sweeper
+
+# chat_id -> poll_id -> poll, as it'll be shown
+active: Dict[int, Dict[uuid.UUID, dict]] = dict()
+
+# (chat_id, poll_type) -> start times of polls that count towards the chat's poll limit, oldest first
+limit_starts: Dict[Tuple[int, PollType], Deque[float]] = dict()
+
+# most recent outcomes, newest last
+recent: Deque[dict] = deque(maxlen=POLL__STATUS_RECENT)
+
+# bumped whenever anything above changes, so that responses can be cached until then
+version: int = 0
+
+# only once we've loaded, and only if the endpoint is on at all; until then, there's nothing to keep up to date
+enabled: bool = False
+
+def _changed():
+    global version
+    version += 1
+
+def _tally(counts: Dict[VoteChoice, int]) -> Dict[str, int]:
+    return {choice.name.lower(): counts.get(choice, 0) for choice in VoteChoice}
+
+def _outcome(poll: Poll, counts: Dict[VoteChoice, int]) -> str:
+    threshold: int = poll.get_threshold()
+    if counts.get(VoteChoice.YES, 0) >= threshold:
+        return 'banned'
+    if counts.get(VoteChoice.NO, 0) >= threshold:
+        return 'kept'
+    return 'expired'
+
+def _entry(poll: Poll, counts: Dict[VoteChoice, int]) -> dict:
+    return {
+        'poll_id': str(poll.poll_id),
+        'poll_type': poll.poll_type.name.lower(),
+        'chat_id': poll.chat_id,
+        'source_id': poll.source_id,
+        'target_id': poll.target_id,
+        'poll_msg_id': poll.poll_msg_id,
+        'started': poll.timestamp.timestamp(),
+        'expires': (poll.timestamp + POLL__LIFETIME).timestamp() if POLL__LIFETIME is not None else None,
+        'tally': _tally(counts),
+        'threshold': poll.get_threshold(),
+    }
+
+def started(poll: Poll):
+    if not enabled:
+        return
+    active.setdefault(poll.chat_id, dict())[poll.poll_id] = _entry(poll, dict())
+    if not poll.forced:
+        limit_starts.setdefault((poll.chat_id, poll.poll_type), deque()).append(poll.timestamp.timestamp())
+    _changed()
+
+def tallied(poll: Poll, counts: Dict[VoteChoice, int]):
+    if not enabled:
+        return
+    entry: Optional[dict] = active.get(poll.chat_id, dict()).get(poll.poll_id)
+    if entry is None:
+        return
+    entry['tally'] = _tally(counts)
+    _changed()
+
+"""
+moves a poll from active to recent; does nothing if it's not (or no longer) active, so it's fine to call more than once
+
+Arguments:
+counts: the final tally, or None to keep the last one we saw
+outcome: 'banned', 'kept', 'expired' or 'cancelled', or None to go by counts
+"""
+def ended(poll: Poll, counts: Optional[Dict[VoteChoice, int]], outcome: Optional[str] = None, now: Optional[float] = None):
+    if not enabled:
+        return
+    chat: Dict[uuid.UUID, dict] = active.get(poll.chat_id, dict())
+    entry: Optional[dict] = chat.pop(poll.poll_id, None)
+    if entry is None:
+        return
+    if not chat:
+        del active[poll.chat_id]
+
+    if counts is not None:
+        entry['tally'] = _tally(counts)
+    entry['outcome'] = outcome or _outcome(poll, counts or dict())
+    entry['ended'] = now or time()
+    recent.append(entry)
+    _changed()
+
+def _sweep(now: float):
+    # polls can also end without us being told (e.g. Poll.get_poll ending a poll that ran out of time),
+    # so anything past its deadline counts as expired from here on
+    for chat in list(active.values()):
+        for entry in list(chat.values()):
+            if entry['expires'] is not None and entry['expires'] <= now:
+                chat.pop(uuid.UUID(entry['poll_id']))
+                entry['outcome'] = 'expired'
+                entry['ended'] = entry['expires']
+                recent.append(entry)
+                _changed()
+    for chat_id in [chat_id for chat_id, chat in active.items() if not chat]:
+        del active[chat_id]
+
+    for (chat_id, _), starts in limit_starts.items():
+        window_start: float = now - chatconfig.get(chat_id).limit_duration.total_seconds()
+        while starts and starts[0] <= window_start:
+            starts.popleft()
+            _changed()
+
+def _limits(now: float) -> List[dict]:
+    keys = set(limit_starts) | {(chat_id, poll_type) for chat_id in chatconfig.chats for poll_type in PollType}
+    limits: List[dict] = []
+    for chat_id, poll_type in sorted(keys):
+        settings: chatconfig.ChatSettings = chatconfig.get(chat_id)
+        starts: Deque[float] = limit_starts.get((chat_id, poll_type), deque())
+        limits.append({
+            'chat_id': chat_id,
+            'poll_type': poll_type.name.lower(),
+            'limit': settings.limit,
+            'used': len(starts),
+            'remaining': max(settings.limit - len(starts), 0),
+            # when the oldest poll in the window stops counting
+            'next_freed': starts[0] + settings.limit_duration.total_seconds() if starts else None,
+        })
+    return limits
+
+def snapshot(now: Optional[float] = None) -> dict:
+    now = now or time()
+    _sweep(now)
+    return {
+        'generated': now,
+        'active': {str(chat_id): sorted(chat.values(), key=lambda entry: entry['started']) for chat_id, chat in active.items()},
+        'limits': _limits(now),
+        'recent': list(reversed(recent)),
+    }
+
+async def load():
+    global enabled
+    await chatconfig.loaded.wait() # thresholds and limits differ per chat
+    now: datetime = datetime.now(tz=pytz.utc)
+
+    polls: List[Poll] = await Poll.filter(ended=False).order_by('timestamp')
+    ended_polls: List[Poll] = await Poll.filter(ended=True).order_by('-timestamp').limit(POLL__STATUS_RECENT)
+
+    counts: Dict[uuid.UUID, Dict[VoteChoice, int]] = {poll.poll_id: dict() for poll in (*polls, *ended_polls)}
+    if counts:
+        for row in await Vote.filter(poll_id__in=list(counts)).annotate(count=Count('vote_id')).group_by('poll_id', 'choice').values('poll_id', 'choice', 'count'):
+            counts[row['poll_id']][row['choice']] = row['count']
+
+    for poll in polls:
+        active.setdefault(poll.chat_id, dict())[poll.poll_id] = _entry(poll, counts[poll.poll_id])
+
+    # we don't know when these actually ended, only when they started
+    for poll in reversed(ended_polls):
+        entry: dict = _entry(poll, counts[poll.poll_id])
+        entry['outcome'] = _outcome(poll, counts[poll.poll_id])
+        entry['ended'] = None
+        recent.append(entry)
+
+    # anything outside a chat's own window gets swept out before it's shown
+    window_start: datetime = now - chatconfig.max_limit_duration()
+    for chat_id, poll_type, timestamp in await Poll.filter(timestamp__gt=window_start, forced=False).order_by('timestamp').values_list('chat_id', 'poll_type', 'timestamp'):
+        limit_starts.setdefault((chat_id, PollType(poll_type)), deque()).append(timestamp.timestamp())
+
+    enabled = True
+    _changed()
+    logger.info(f"Loaded status for {len(polls)} active polls")
+
+# path -> (version, second, response body); a dashboard polling every second gets the same bytes until something changes
+_cache = cachetools.LRUCache(maxsize=64)
+
+def _body(path: str) -> Optional[bytes]:
+    parts: List[str] = [part for part in path.split('?', 1)[0].split('/') if part]
+    second: int = int(monotonic())
+    key: str = '/'.join(parts)
+    cached: Optional[Tuple[int, int, bytes]] = _cache.get(key)
+    if cached is not None and cached[:2] == (version, second):
+        return cached[2]
+
+    data: dict = snapshot()
+    if not parts:
+        result: object = data
+    elif parts[0] in ('active', 'limits', 'recent') and len(parts) <= 2:
+        result = data[parts[0]]
+        if len(parts) == 2:
+            # just the one chat
+            try:
+                chat_id: int = int(parts[1])
+            except ValueError:
+                return None
+            if parts[0] == 'active':
+                result = result.get(str(chat_id), [])
+            else:
+                result = [entry for entry in result if entry['chat_id'] == chat_id]
+    else:
+        return None
+
+    body: bytes = json.dumps(result, separators=(',', ':')).encode('utf-8')
+    _cache[key] = (version, second, body)
+    return body
+
+async def _respond(writer: asyncio.StreamWriter, status: str, body: bytes):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('ascii')
+        + body
+    )
+    await writer.drain()
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request: bytes = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=10)
+        method, path, *_ = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+        if method != 'GET':
+            await _respond(writer, '405 Method Not Allowed', b'{"error":"method not allowed"}')
+            return
+
+        body: Optional[bytes] = _body(path)
+        if body is None:
+            await _respond(writer, '404 Not Found', b'{"error":"not found"}')
+        else:
+            await _respond(writer, '200 OK', body)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError, ValueError):
+        pass # not worth logging, whoever it was can try again
+    except Exception:
+        logger.exception("Got exception while answering a status request")
+    finally:
+        writer.close()
+
+"""
+serves the snapshot as json over plain http, read-only:
+
+/                   everything below
+/active[/CHAT_ID]   active polls per chat, with their tallies
+/limits[/CHAT_ID]   how many more polls can be started per (chat, poll type) before the poll limit kicks in
+/recent[/CHAT_ID]   the last POLL__STATUS_RECENT outcomes, newest first
+"""
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    server: asyncio.AbstractServer = await asyncio.start_server(_handle, host, port)
+    logger.info(f"Serving poll status on http://{host}:{port}/")
+    return server
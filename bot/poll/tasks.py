@@ -0,0 +1,238 @@
+import asyncio
+import logging
+
+from time import monotonic, time
+from typing import Dict, List, Optional, Union
+
+from telethon import Button
+from telethon.errors.rpcerrorlist import FloodWaitError
+from telethon.tl.types import ChannelParticipantAdmin, ChannelParticipantCreator, PeerChannel, PeerUser
+
+from bot.poll import chatconfig, expiry, fingerprint, propagation, reputation, status
+from bot.poll.models import BanPropagation, ChatPollConfig, Poll, PropagationStatus, VoteChoice
+from bot.poll.telegram import build_bob_message, client, get_channel, get_participant
+from config import POLL__REPUTATION_FLUSH_INTERVAL, POLL__PROPAGATE_BANS, POLL__PROPAGATE_INTERVAL, POLL__PROPAGATE_BATCH_SIZE, POLL__EXPIRY_BATCH_SIZE, POLL__EDIT_INTERVAL
+from config import POLL__STATUS_HOST, POLL__STATUS_PORT, POLL__CONFIG_RELOAD_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+async def task_chat_config():
+    force: bool = False
+    while True:
+        try:
+            # newly looked up POLL__CHANNELS need applying even if the rows haven't changed
+            force = await chatconfig.resolve_channels(client) or force
+            # one cheap query, unless something's actually changed
+            await ChatPollConfig.reload(force=force)
+            force = False
+        except Exception:
+            logger.exception("Got exception while reloading poll settings")
+
+        if not chatconfig.loaded.is_set():
+            # handlers wait for this, so better to go by POLL__* alone than not at all
+            logger.warning("Couldn't load poll settings, going by POLL__CHANNELS and the POLL__* defaults until we can")
+            chatconfig.loaded.set()
+
+        await asyncio.sleep(POLL__CONFIG_RELOAD_INTERVAL.total_seconds())
+
+async def task_reputation():
+    try:
+        await reputation.load()
+    except Exception:
+        logger.exception("Got exception while loading reputations")
+
+    try:
+        while True:
+            await asyncio.sleep(POLL__REPUTATION_FLUSH_INTERVAL.total_seconds())
+            try:
+                await reputation.flush()
+            except Exception:
+                logger.exception("Got exception while flushing reputations")
+    except asyncio.CancelledError:
+        # we're shutting down, so save whatever we've got
+        await reputation.flush()
+        raise
+
+
+# chat_id -> monotonic() of the last ban we propagated there
+last_ban: Dict[int, float] = dict()
+
+async def set_status(entries: List[BanPropagation], status: PropagationStatus):
+    if entries:
+        await BanPropagation.filter(id__in=[entry.id for entry in entries]).update(status=status)
+
+"""
+Returns:
+True if anything was left pending to try again later, False otherwise
+"""
+async def propagate_chat(chat_id: int, entries: List[BanPropagation]) -> bool:
+    try:
+        channel: PeerChannel = await get_channel(chat_id, get_peer=True)
+    except ValueError:
+        logger.warning(f"Can't find chat {chat_id} to propagate bans to!")
+        await set_status(entries, PropagationStatus.FAILED)
+        return False
+
+    # check all the users in one go, instead of one at a time in between bans
+    participants = await asyncio.gather(
+        *(get_participant(channel, PeerUser(entry.ban.user_id)) for entry in entries),
+        return_exceptions=True,
+    )
+
+    flood_wait: Optional[FloodWaitError] = next((participant for participant in participants if isinstance(participant, FloodWaitError)), None)
+    if flood_wait is not None:
+        # leave them all pending, we'll get back to them
+        logger.warning(f"Got flood wait of {flood_wait.seconds}s while checking participants of {chat_id}")
+        await asyncio.sleep(flood_wait.seconds)
+        return True
+
+    to_ban: List[BanPropagation] = []
+    not_participant: List[BanPropagation] = []
+    failed: List[BanPropagation] = []
+    retry: bool = False
+    for entry, participant in zip(entries, participants):
+        if isinstance(participant, Exception):
+            # could be anything from a network hiccup to telegram having a bad day, so try again later
+            logger.warning(f"Couldn't check if {entry.ban.user_id} is in {chat_id}, will try again later: {participant!r}")
+            retry = True
+        elif participant is None:
+            not_participant.append(entry)
+        elif isinstance(participant.participant, (ChannelParticipantAdmin, ChannelParticipantCreator)):
+            logger.warning(f"Not propagating ban of {entry.ban.user_id} to {chat_id}, they're an admin there")
+            failed.append(entry)
+        else:
+            to_ban.append(entry)
+
+    await set_status(not_participant, PropagationStatus.NOT_PARTICIPANT)
+    await set_status(failed, PropagationStatus.FAILED)
+
+    for entry in to_ban:
+        wait: float = last_ban.get(chat_id, 0) + POLL__PROPAGATE_INTERVAL.total_seconds() - monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        try:
+            await client.edit_permissions(channel, PeerUser(entry.ban.user_id), view_messages=False)
+            status: PropagationStatus = PropagationStatus.BANNED
+            logger.info(f"Propagated ban of {entry.ban.user_id} to {chat_id}")
+        except FloodWaitError as e:
+            # leave the rest pending, we'll get back to them
+            logger.warning(f"Got flood wait of {e.seconds}s while propagating bans to {chat_id}")
+            await asyncio.sleep(e.seconds)
+            return True
+        except Exception:
+            logger.exception(f"Uh oh, got exception while propagating ban of {entry.ban.user_id} to {chat_id}")
+            status = PropagationStatus.FAILED
+        finally:
+            last_ban[chat_id] = monotonic()
+
+        # one at a time, so that we can pick up where we left off after a restart
+        await set_status([entry], status)
+
+    return retry
+
+async def task_ban_propagation():
+    if not POLL__PROPAGATE_BANS:
+        return
+
+    while True:
+        propagation.wakeup.clear()
+        pending: List[BanPropagation] = []
+        retry: bool = False
+
+        try:
+            pending = await BanPropagation.filter(status=PropagationStatus.PENDING).order_by('id').limit(POLL__PROPAGATE_BATCH_SIZE).prefetch_related('ban')
+
+            by_chat: Dict[int, List[BanPropagation]] = dict()
+            for entry in pending:
+                by_chat.setdefault(entry.chat_id, []).append(entry)
+
+            # chats are rate limited separately, so they can go in parallel
+            retry = any(await asyncio.gather(*(propagate_chat(chat_id, entries) for chat_id, entries in by_chat.items())))
+        except Exception:
+            logger.exception("Got exception while propagating bans")
+
+        # whatever got left pending would just fail the same way again if we went straight back to it
+        if len(pending) < POLL__PROPAGATE_BATCH_SIZE or retry:
+            try:
+                await asyncio.wait_for(propagation.wakeup.wait(), timeout=5*60)
+            except asyncio.TimeoutError:
+                pass
+
+async def task_fingerprint_index():
+    try:
+        await fingerprint.load()
+    except Exception:
+        logger.exception("Got exception while loading scam fingerprints")
+
+
+async def edit_expired(chat_id: int, poll_msg_id: int, poll: Poll, counts: Dict[VoteChoice, int]):
+    msg_dict: Dict[str, Union[str, List[Button]]] = await build_bob_message(poll, True, counts, expired=True)
+    try:
+        await client.edit_message(chat_id, poll_msg_id, msg_dict['message'], buttons=None)
+    except FloodWaitError as e:
+        logger.warning(f"Got flood wait of {e.seconds}s while editing expired poll {poll.poll_id}")
+        await asyncio.sleep(e.seconds)
+        await client.edit_message(chat_id, poll_msg_id, msg_dict['message'], buttons=None)
+
+async def task_poll_expiry():
+    try:
+        await expiry.load()
+    except Exception:
+        logger.exception("Got exception while loading poll deadlines")
+
+    while True:
+        expiry.wakeup.clear()
+
+        try:
+            while await expiry.expire_due(POLL__EXPIRY_BATCH_SIZE) >= POLL__EXPIRY_BATCH_SIZE:
+                await asyncio.sleep(0)
+        except Exception:
+            logger.exception("Got exception while expiring polls")
+
+        deadline: Optional[float] = expiry.next_deadline()
+        try:
+            await asyncio.wait_for(expiry.wakeup.wait(), timeout=None if deadline is None else max(deadline - time(), 0) + 1)
+        except asyncio.TimeoutError:
+            pass
+
+# edits go through here one at a time, so that a big batch of expired polls doesn't get us flood limited
+async def task_poll_expiry_edits():
+    try:
+        while True:
+            chat_id, poll_msg_id, poll, counts = await expiry.pending_edits.get()
+            try:
+                await edit_expired(chat_id, poll_msg_id, poll, counts)
+            except Exception:
+                logger.exception(f"Uh oh, got exception while editing expired poll {poll.poll_id}")
+
+            await asyncio.sleep(POLL__EDIT_INTERVAL.total_seconds())
+    except asyncio.CancelledError:
+        # we're shutting down, so get the rest of them done while we still can
+        edited: int = 0
+        while not expiry.pending_edits.empty():
+            chat_id, poll_msg_id, poll, counts = expiry.pending_edits.get_nowait()
+            try:
+                await edit_expired(chat_id, poll_msg_id, poll, counts)
+                edited += 1
+            except Exception:
+                logger.exception(f"Uh oh, got exception while editing expired poll {poll.poll_id}")
+        if edited:
+            logger.info(f"Edited {edited} expired polls on the way out")
+        raise
+
+async def task_status():
+    if POLL__STATUS_PORT is None:
+        return
+
+    try:
+        await status.load()
+        server: asyncio.AbstractServer = await status.serve(POLL__STATUS_HOST, POLL__STATUS_PORT)
+    except Exception:
+        logger.exception("Got exception while starting the status endpoint")
+        return
+
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
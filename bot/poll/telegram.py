@@ -1,14 +1,16 @@
 import math
 import asyncio
-from typing import Dict, List, Optional, Union
+from time import monotonic
+from typing import Dict, List, Optional, Tuple, Union
 
 import cachetools
 from tortoise.exceptions import DoesNotExist
 
+from bot.poll import chatconfig, expiry, fingerprint, propagation, reputation, status
 from bot.poll.models import Poll, PollLimitReached, VoteChoice
 from bot.util import Timer
-from config import POLL__LIMIT_DURATION, TG_BOT_ID, TG_BOT_USERNAME, POLL__CHANNELS, POLL__THRESHOLD
-from ..telegram import client
+from config import TG_BOT_ID, TG_BOT_USERNAME, POLL__FINGERPRINT_ACTION, TG_CALLBACK_ANSWER_WINDOW
+from ..telegram import client, catchup
 from ..models import TelegramUser, TelegramChat
 
 from telethon import events, Button, utils
@@ -126,7 +128,8 @@ async def get_message(channel, msg_id) -> Message:
         return m
 
 
-async def build_bob_message(poll: Poll, ended: bool, counts: Dict[VoteChoice, int], winner: VoteChoice = None) -> Dict[str, Union[str, List[Button]]]:
+async def build_bob_message(poll: Poll, ended: bool, counts: Dict[VoteChoice, int], winner: VoteChoice = None, expired: bool = False) -> Dict[str, Union[str, List[Button]]]:
+    threshold: int = poll.get_threshold()
     if not ended:
         message_lines = [
             f"{poll.source.get_link()} would like to kick {poll.target.get_link()}.",
@@ -135,8 +138,8 @@ async def build_bob_message(poll: Poll, ended: bool, counts: Dict[VoteChoice, in
 
         # make sure button data is less than... 64 bytes? 14 bytes + 36 for uuid = 50, nice
         buttons = [
-            Button.inline(f"Yes: {counts.get(VoteChoice.YES, 0)}/{POLL__THRESHOLD}", f"poll_vote {poll.poll_id} yes"),
-            Button.inline(f"No: {counts.get(VoteChoice.NO, 0)}/{POLL__THRESHOLD}", f"poll_vote {poll.poll_id} no"),
+            Button.inline(f"Yes: {counts.get(VoteChoice.YES, 0)}/{threshold}", f"poll_vote {poll.poll_id} yes"),
+            Button.inline(f"No: {counts.get(VoteChoice.NO, 0)}/{threshold}", f"poll_vote {poll.poll_id} no"),
         ]
 
         return {
@@ -144,6 +147,16 @@ async def build_bob_message(poll: Poll, ended: bool, counts: Dict[VoteChoice, in
             "poll": poll,
             "buttons": buttons,
         }
+    elif expired: # poll ran out of time before anyone won
+        message_lines = [
+            f"The poll to kick {poll.target.get_link()} has expired without enough votes, so we've done nothing.",
+            f"Final tally: Yes: {counts.get(VoteChoice.YES, 0)}/{threshold}, No: {counts.get(VoteChoice.NO, 0)}/{threshold}"
+        ]
+
+        return {
+            "message": '\n'.join(message_lines),
+            "poll": poll,
+        }
     elif winner is None: # poll ended, but no winner
         logger.warning(f"Poll {poll.poll_id} ended, but there was no winner!")
         message_lines = [
@@ -171,14 +184,23 @@ async def build_bob_message(poll: Poll, ended: bool, counts: Dict[VoteChoice, in
 
 
 async def bob_vote(poll: Poll, user: TelegramUser, choice: VoteChoice) -> Dict[str, Union[str, List[Button]]]:
-    changed: bool = await poll.vote(user, choice)
+    return await bob_votes(poll, [(user, choice)])
 
-    counts: Dict[VoteChoice, int] = await poll.get_vote_stats()
+"""
+applies several votes to a poll, and then does whatever needs doing just once
+"""
+async def bob_votes(poll: Poll, votes: List[Tuple[TelegramUser, VoteChoice]]) -> Dict[str, Union[str, List[Button]]]:
+    changed: bool
+    counts: Dict[VoteChoice, int]
+    changed, counts = await poll.vote_many(votes)
 
     ended = poll.ended
-    choice = await poll.vote_winner()
+    choice = poll.get_winner(counts)
 
     if ended:
+        reputation.record_outcome(poll, choice)
+        status.ended(poll, counts)
+
         need_delete_perms: bool = False
         need_ban_perms: bool = False
         if choice == VoteChoice.YES:
@@ -188,6 +210,11 @@ async def bob_vote(poll: Poll, user: TelegramUser, choice: VoteChoice) -> Dict[s
                 msg = await get_message(channel_ent, poll.msg_id)
 
             if msg is not None:
+                try:
+                    await fingerprint.record(poll, msg)
+                except Exception:
+                    logger.exception(f"Uh oh, got an exception while trying to fingerprint a message ({poll})")
+
                 try:
                     await msg.delete()
                 except MessageDeleteForbiddenError:
@@ -206,6 +233,8 @@ async def bob_vote(poll: Poll, user: TelegramUser, choice: VoteChoice) -> Dict[s
                 need_ban_perms = True
             except Exception:
                 logger.exception(f"Uh oh, got exception while trying to ban a user ({poll})")
+
+            await propagation.queue_ban(poll)
         
         bob_message: Dict[str, Union[str, List[Button]]] = await build_bob_message(poll, ended, counts, winner = choice)
         if not need_delete_perms and not need_ban_perms:
@@ -215,6 +244,8 @@ async def bob_vote(poll: Poll, user: TelegramUser, choice: VoteChoice) -> Dict[s
             bob_message['message'] += perms_msg
             return bob_message
     else:
+        if changed:
+            status.tallied(poll, counts)
         bob_message: Dict[str, Union[str, List[Button]]] = await build_bob_message(poll, ended, counts)
         bob_message['unchanged'] = not changed
         return bob_message
@@ -241,15 +272,39 @@ def pretty_timedelta(td: timedelta) -> str:
     return ', '.join(parts)
 
 
+# updates held back while catching up on a backlog, see bot.telegram.CatchUp
+pending_bobs: List[NewMessage.Event] = []
+pending_votes: Dict[str, Dict[int, Tuple[VoteChoice, events.CallbackQuery.Event, Optional[float]]]] = dict() # poll_id -> user_id -> (choice, event, time received, see answer_if_fresh)
+
 regex_bob = re.compile(fr'^/(?P<cmd>bob|ngmi)(?:@{TG_BOT_USERNAME})?( *| +(?P<target>.+))$', re.I)
-@events.register(events.NewMessage(incoming=True, pattern=regex_bob, chats=POLL__CHANNELS))
+@events.register(events.NewMessage(incoming=True, pattern=regex_bob, func=chatconfig.in_chats))
 async def handler_bob(event: NewMessage):
+    await chatconfig.loaded.wait()
+    if not chatconfig.in_chats(event):
+        return
+    if catchup.active or catchup.is_stale(event.message.date):
+        # this is part of a backlog, deal with it once we've caught up
+        catchup.begin()
+        pending_bobs.append(event)
+        catchup.touch()
+        return
+
+    await bob(event)
+
+async def bob(event: NewMessage):
     chat_ent: PeerChannel = event.to_id
     if not isinstance(chat_ent, PeerChannel):
         logger.error(f"Got handler_bob event from a {type(chat_ent)} instead of a PeerChannel!")
         return
 
     cmd: str = event.pattern_match.group('cmd')
+    chat_id: int = utils.get_peer_id(chat_ent)
+
+    # in-memory, so it costs nothing to find out now. it only matters if this /bob would start a new poll though,
+    # anyone can still add their vote to one that's already running
+    source_rejection: Optional[str] = reputation.check_source(chat_id, event.sender_id)
+    if source_rejection is not None and isinstance(event.from_id, PeerUser) and await is_admin(chat_ent, event.from_id):
+        source_rejection = None
 
     bob_arg: Union[str, int] = event.pattern_match.group('target')
     entities: Optional[List[TypeMessageEntity]] = None
@@ -293,14 +348,20 @@ async def handler_bob(event: NewMessage):
         Timer(30, msg.delete)
         return
 
+    if isinstance(target_ent, PeerUser):
+        rejection = reputation.check_target(chat_id, target_ent.user_id)
+        if rejection is not None and not (isinstance(event.from_id, PeerUser) and await is_admin(chat_ent, event.from_id)):
+            logger.warning(f"Rejected /{cmd} by {event.sender_id} against {target_ent.user_id} in {chat_id}: {rejection}")
+            msg: Message = await event.reply(rejection)
+            Timer(30, msg.delete)
+            return
+
     from_user_ent: PeerUser = event.from_id
     from_user = None
     is_user: bool = isinstance(event.from_id, (PeerUser, User, InputPeerUser))
 
     if is_user:
         from_user: TelegramUser = await TelegramUser.get_user(client, from_user_ent.user_id)
-
-        chat_id: int = utils.get_peer_id(chat_ent)
         chat: TelegramChat = await TelegramChat.get_chat(client, chat_id)
     else:
         logger.warning(f"User {from_user_ent} doesn't appear to be a user!")
@@ -334,7 +395,13 @@ async def handler_bob(event: NewMessage):
     already_exists: bool
     poll: Poll
     try:
-        already_exists, poll = await Poll.get_poll(chat=chat, target=target, source=from_user, msg_id=target_msg_id, force=force)
+        already_exists, poll = await Poll.get_poll(chat=chat, target=target, source=from_user, msg_id=target_msg_id, force=force, create=source_rejection is None)
+        if poll is None:
+            logger.warning(f"Rejected /{cmd} by {event.sender_id} in {chat_id}: {source_rejection}")
+            msg: Message = await event.reply(source_rejection)
+            Timer(30, msg.delete)
+            return
+
         if already_exists:
             msg: Optional[Message] = None
 
@@ -368,7 +435,13 @@ async def handler_bob(event: NewMessage):
             else:
                 logger.warning("Our old poll message got deleted for some reason!")
                 await poll.force_end()
-                _, poll = await Poll.get_poll(chat=chat, target=target, source=from_user, msg_id=target_msg_id, force=True) # ahh heck, whatever
+                status.ended(poll, None, 'cancelled')
+                _, poll = await Poll.get_poll(chat=chat, target=target, source=from_user, msg_id=target_msg_id, force=True, create=source_rejection is None) # ahh heck, whatever
+                if poll is None:
+                    logger.warning(f"Rejected /{cmd} by {event.sender_id} in {chat_id}: {source_rejection}")
+                    msg: Message = await event.reply(source_rejection)
+                    Timer(30, msg.delete)
+                    return
 
 
         msg_dict: Dict[str, Union[str, List[Button]]] = await bob_vote(poll, from_user, VoteChoice.YES)
@@ -380,23 +453,28 @@ async def handler_bob(event: NewMessage):
             )
 
             await poll.set_poll_msg_id(msg.id)
+            if not poll.forced: # same as reputation.load, which only counts unforced polls
+                reputation.record_initiation(chat_id, from_user.user_id)
+            expiry.schedule(poll)
+            status.started(poll)
         except Exception:
             logger.warning("Got error while trying to send message!")
             await poll.delete()
             return
     except PollLimitReached:
-        await event.reply(f"Too many ban attempts in the past {pretty_timedelta(POLL__LIMIT_DURATION)}. Please contact an admin instead.")
+        await event.reply(f"Too many ban attempts in the past {pretty_timedelta(chatconfig.get(chat_id).limit_duration)}. Please contact an admin instead.")
 
 
 regex_bob_callback = re.compile("^poll_vote (?P<poll_id>[a-f0-9]{8}-[a-f0-9]{4}-4[a-f0-9]{3}-[89ab][a-f0-9]{3}-[a-f0-9]{12}) (?P<choice>[a-z_]+)$", re.I)
 @events.register(events.CallbackQuery(data=re.compile(b'poll_vote ')))
 async def handler_bob_callback(event):
-    bot_msg: Message = await event.get_message()
+    await chatconfig.loaded.wait()
     data: str = event.data.decode('ascii')
     match: re.Match = regex_bob_callback.match(data)
 
     if not match:
         logger.error("bob_callback data doesn't match regex!")
+        bot_msg: Message = await event.get_message()
         await bot_msg.edit(bot_msg.text + '\n\n' + f"Oops, something went wrong!", buttons=None)
         return
     
@@ -409,9 +487,20 @@ async def handler_bob_callback(event):
         choice: VoteChoice = VoteChoice.NO
     else:
         logger.error(f"bob_callback data got an invalid choice ({choice_str})!")
+        bot_msg: Message = await event.get_message()
         await bot_msg.edit(bot_msg.text + '\n\n' + f"Oops, something went wrong!", buttons=None)
         return
 
+    if catchup.active:
+        # we're working through a backlog, so only the last button press per user per poll matters
+        # button presses don't say when they were made, so there's no telling how old the ones in the backlog are
+        received: Optional[float] = monotonic() if catchup.draining else None
+        pending_votes.setdefault(poll_id, dict())[event.sender_id] = (choice, event, received)
+        catchup.touch()
+        return
+
+    bot_msg: Message = await event.get_message()
+
     try:
         poll: Poll = await Poll.get_poll_by_id(poll_id=poll_id)
     except DoesNotExist:
@@ -419,6 +508,11 @@ async def handler_bob_callback(event):
         await bot_msg.edit(bot_msg.text + '\n\n' + f"Oops, something went wrong!", buttons=None)
         return
 
+    if poll.is_expired():
+        # task_poll_expiry will get to it soon enough
+        await event.answer("This poll has expired.")
+        return
+
     sender = await event.get_input_sender()
     user: TelegramUser = await TelegramUser.get_user(client, user_id=event.sender_id)
 
@@ -436,3 +530,151 @@ async def handler_bob_callback(event):
     else:
         logger.warning(f"User {user} is trying to vote in poll {poll} despite not being in the channel!")
         await event.answer()
+
+
+
+"""
+received: monotonic() as of when the button press came in, or None if it came in with a backlog
+"""
+async def answer_if_fresh(event: events.CallbackQuery.Event, received: Optional[float], *args, **kwargs):
+    # telegram stops accepting answers to a callback query after a while, so don't bother
+    if received is None or monotonic() - received > TG_CALLBACK_ANSWER_WINDOW.total_seconds():
+        return
+
+    try:
+        await event.answer(*args, **kwargs)
+    except Exception:
+        logger.warning("Got error while trying to answer a callback query!")
+
+async def apply_pending_votes(poll_id: str, pending: Dict[int, Tuple[VoteChoice, events.CallbackQuery.Event, Optional[float]]]):
+    try:
+        poll: Poll = await Poll.get_poll_by_id(poll_id=poll_id)
+    except DoesNotExist:
+        logger.error(f"Got backlogged votes for a poll that doesn't exist ({poll_id})!")
+        return
+
+    if poll.is_expired():
+        for choice, event, received in pending.values():
+            await answer_if_fresh(event, received, "This poll has expired.")
+        return
+
+    # everyone at once, instead of one round trip after another
+    channel: PeerChannel = PeerChannel(poll.chat.chat_id)
+    senders = await asyncio.gather(*(event.get_input_sender() for _, event, _ in pending.values()))
+    participants: List[bool] = await asyncio.gather(*(is_participant(channel, sender) for sender in senders))
+
+    accepted: Dict[int, Tuple[VoteChoice, events.CallbackQuery.Event, Optional[float]]] = dict()
+    for (user_id, (choice, event, received)), participant in zip(pending.items(), participants):
+        if not participant:
+            logger.warning(f"User {user_id} is trying to vote in poll {poll} despite not being in the channel!")
+            await answer_if_fresh(event, received)
+            continue
+        accepted[user_id] = (choice, event, received)
+
+    if not accepted:
+        return
+
+    users: List[TelegramUser] = await asyncio.gather(*(TelegramUser.get_user(client, user_id=user_id) for user_id in accepted))
+    votes: List[Tuple[TelegramUser, VoteChoice]] = [(user, choice) for user, (choice, _, _) in zip(users, accepted.values())]
+
+    msg_dict: Dict[str, Union[str, List[Button]]] = await bob_votes(poll, votes)
+    if not msg_dict.get('unchanged', False):
+        await client.edit_message(
+            poll.chat.chat_id,
+            poll.poll_msg_id,
+            msg_dict['message'],
+            buttons = msg_dict.get('buttons')
+        )
+
+    for choice, event, received in accepted.values():
+        await answer_if_fresh(event, received, f"You've voted for {choice.name.capitalize()}!")
+
+@catchup.on_drain
+async def drain_votes() -> int:
+    handled: int = 0
+    while pending_votes:
+        poll_id, pending = pending_votes.popitem()
+        handled += 1
+        try:
+            await apply_pending_votes(poll_id, pending)
+        except Exception:
+            logger.exception(f"Uh oh, got exception while applying backlogged votes for poll {poll_id}")
+
+    return handled
+
+@catchup.on_drain
+async def drain_bobs() -> int:
+    handled: int = 0
+    while pending_bobs:
+        event: NewMessage.Event = pending_bobs.pop(0)
+        handled += 1
+        try:
+            await bob(event)
+        except Exception:
+            logger.exception("Uh oh, got exception while handling a backlogged /bob")
+
+    return handled
+
+@events.register(events.NewMessage(incoming=True, func=chatconfig.in_chats))
+async def handler_fingerprint(event: NewMessage):
+    await chatconfig.loaded.wait()
+    if not chatconfig.in_chats(event):
+        return
+    if not POLL__FINGERPRINT_ACTION or not len(fingerprint.index):
+        return
+
+    msg: Message = event.message
+    if not msg.message or msg.message.startswith('/'):
+        return
+
+    fp_id: Optional[int] = fingerprint.index.match(msg.message, fingerprint.get_urls(msg))
+    if fp_id is None:
+        return
+
+    chat_ent: PeerChannel = event.to_id
+    from_user_ent: PeerUser = event.from_id
+    if not isinstance(chat_ent, PeerChannel) or not isinstance(from_user_ent, PeerUser):
+        return
+
+    if from_user_ent.user_id == TG_BOT_ID or await is_admin(chat_ent, from_user_ent):
+        return
+
+    chat_id: int = utils.get_peer_id(chat_ent)
+    logger.info(f"Message {msg.id} by {from_user_ent.user_id} in {chat_id} matches scam fingerprint {fp_id}")
+
+    if POLL__FINGERPRINT_ACTION == 'delete':
+        try:
+            await msg.delete()
+        except MessageDeleteForbiddenError:
+            logger.warning(f"No message delete permissions in {chat_id}!")
+        return
+
+    # otherwise, start a poll on the sender's behalf, like a /bob on their message
+    if reputation.check_target(chat_id, from_user_ent.user_id) is not None:
+        return
+
+    source: TelegramUser = await TelegramUser.get_user(client, TG_BOT_ID)
+    target: TelegramUser = await TelegramUser.get_user(client, from_user_ent.user_id)
+    chat: TelegramChat = await TelegramChat.get_chat(client, chat_id)
+
+    try:
+        already_exists, poll = await Poll.get_poll(chat=chat, target=target, source=source, msg_id=msg.id)
+    except PollLimitReached:
+        logger.warning(f"Not starting a poll for scam fingerprint {fp_id}, poll limit reached in {chat_id}")
+        return
+
+    if already_exists:
+        return
+
+    msg_dict: Dict[str, Union[str, List[Button]]] = await build_bob_message(poll, False, dict())
+    try:
+        poll_msg: Message = await msg.reply(
+            msg_dict['message'],
+            buttons = msg_dict.get('buttons')
+        )
+        await poll.set_poll_msg_id(poll_msg.id)
+        expiry.schedule(poll)
+        status.started(poll)
+    except Exception:
+        logger.warning("Got error while trying to send message!")
+        await poll.delete()
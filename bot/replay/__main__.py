@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Pushes updates recorded with REPLAY__RECORD_PATH through the registered handlers, against a stub client
+(see bot.stub) and a scratch database, and reports how long they took.
+
+usage: python3 -m bot.replay LOG [LOG ...] [--max | --speed N] [--rpc-latency MS] [--db URL]
+
+By default, updates are replayed with the same timing as when they were recorded (or N times as fast with
+--speed N), each one in its own task like telethon does, so latencies include waiting on whatever else is
+running at the time. --max replays them back to back instead, one at a time.
+
+--rpc-latency makes every call to telegram take that long, since the stub otherwise answers right away.
+"""
+import argparse
+import asyncio
+import gzip
+import importlib
+import inspect
+import json
+import logging
+import os
+import time
+import warnings
+
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from telethon import events
+from telethon.tl.types import MessageEntityMention, MessageEntityMentionName
+from tortoise import Tortoise
+
+from bot.poll import chatconfig
+from bot.poll.models import ChatPollConfig, Poll
+from bot.stub import StubCallbackQuery, StubClient, StubMessage, StubNewMessage
+
+logger = logging.getLogger(__name__)
+
+def load(paths: Iterable[str]) -> List[dict]:
+    entries: List[dict] = []
+    for path in paths:
+        with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')) as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries
+
+"""
+whether telethon would hand `event` to a handler registered with `builder`, as far as chats go: its chats=...
+(e.g. bot.debug's TG_LOG_CHANNEL) and its func=... (e.g. chatconfig.in_chats, for the chats we run polls in)
+"""
+def accepts(builder, event) -> bool:
+    chats = builder.chats
+    if chats is not None:
+        if not isinstance(chats, (list, tuple, set, frozenset)):
+            chats = (chats,)
+        if event.chat_id not in chats:
+            return False
+    return builder.func is None or builder.func(event)
+
+"""
+imports every bot.<module>.telegram and bot.<module>.models, like bot.__main__ does
+
+Returns:
+the handler modules, the NewMessage handlers and CallbackQuery handlers (as (handler, event builder) tuples;
+see accepts for which chats they're for), and the model modules for tortoise
+"""
+def discover() -> Tuple[list, List[Tuple[Callable, events.NewMessage]], List[Tuple[Callable, events.CallbackQuery]], List[str]]:
+    bot_path: str = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    modules: List[str] = sorted(f for f in os.listdir(bot_path) if f not in ('__pycache__', 'replay') and os.path.isdir(f"{bot_path}/{f}"))
+
+    handler_modules = []
+    message_handlers: List[Tuple[Callable, events.NewMessage]] = []
+    callback_handlers: List[Tuple[Callable, events.CallbackQuery]] = []
+    tortoise_models: List[str] = ['bot.models']
+    for module in modules:
+        for kind in ('telegram', 'models'):
+            modname = f"bot.{module}.{kind}"
+            try:
+                mod = importlib.import_module(modname)
+            except ModuleNotFoundError as e:
+                if str(e) != f"No module named '{modname}'":
+                    raise
+                continue
+
+            if kind == 'models':
+                tortoise_models.append(modname)
+                continue
+
+            handler_modules.append(mod)
+            for funcname, func in inspect.getmembers(mod, inspect.iscoroutinefunction):
+                if not funcname.startswith('handler_'):
+                    continue
+                for builder in events.list(func):
+                    if isinstance(builder, events.NewMessage):
+                        message_handlers.append((func, builder))
+                    elif isinstance(builder, events.CallbackQuery):
+                        callback_handlers.append((func, builder))
+
+    return handler_modules, message_handlers, callback_handlers, tortoise_models
+
+def percentile(values: List[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class Replayer:
+    def __init__(self, stub: StubClient, message_handlers, callback_handlers):
+        self.stub = stub
+        self.message_handlers = message_handlers
+        self.callback_handlers = callback_handlers
+        self.latencies: Dict[str, List[float]] = defaultdict(list) # handler name, or 'update' -> seconds
+        self.skipped: int = 0
+        self.errors: int = 0
+
+    def add_users(self, entries: List[dict]):
+        for entry in entries:
+            self.stub.add_chat(entry['chat'])
+            for user_id in (entry['user'], entry.get('target'), *(m for m in entry.get('mentions', ()) if isinstance(m, int))):
+                if user_id is not None:
+                    self.stub.add_user(user_id)
+            for username in (m for m in entry.get('mentions', ()) if isinstance(m, str)):
+                self.stub.add_user(int(username[2:], 16) & 0x7fffffff or 1, username[1:])
+
+    def build_message(self, entry: dict) -> StubMessage:
+        chat_id: int = entry['chat']
+        reply_to: Optional[StubMessage] = None
+        if entry['reply_to'] is not None:
+            reply_to = self.stub.messages.get((chat_id, entry['reply_to']))
+            if reply_to is None:
+                # from before the recording started; make up a sender for it
+                sender_id: int = hash((chat_id, entry['reply_to'])) & 0x3fffffff or 1
+                self.stub.add_user(sender_id)
+                reply_to = self.stub.message(chat_id, sender_id, '', msg_id=entry['reply_to'])
+
+        entities = [
+            (MessageEntityMentionName(offset=0, length=0, user_id=mention), '') if isinstance(mention, int) else (MessageEntityMention(offset=0, length=len(mention)), mention)
+            for mention in entry['mentions']
+        ]
+        return self.stub.message(chat_id, entry['user'], entry['text'], reply_to=reply_to, msg_id=entry['msg'], entities=entities)
+
+    async def build_callback(self, entry: dict) -> Optional[Tuple[StubCallbackQuery, bytes]]:
+        if entry['target'] is None:
+            return None
+
+        # the poll ids in the replay aren't the ones that were recorded, so go by who it's against
+        poll: Optional[Poll] = await Poll.filter(chat_id=entry['chat'], target_id=entry['target'], ended=False).first()
+        if poll is None or poll.poll_msg_id is None:
+            return None
+
+        message: Optional[StubMessage] = self.stub.messages.get((entry['chat'], poll.poll_msg_id))
+        if message is None:
+            return None
+
+        data: bytes = f"poll_vote {poll.poll_id} {entry['choice']}".encode('ascii')
+        return StubCallbackQuery(self.stub, message, entry['user'], data), data
+
+    async def dispatch(self, entry: dict, scheduled: float):
+        calls: List[Tuple[Callable, object]] = []
+        if entry['type'] == 'message':
+            msg: StubMessage = self.build_message(entry)
+            for handler, builder in self.message_handlers:
+                if builder.pattern and not builder.pattern(msg.message):
+                    continue
+                event = StubNewMessage(self.stub, msg, builder.pattern)
+                if not accepts(builder, event):
+                    continue
+                calls.append((handler, event))
+        else:
+            callback = await self.build_callback(entry)
+            if callback is None:
+                self.skipped += 1
+                return
+            event, data = callback
+            for handler, builder in self.callback_handlers:
+                if builder.match and not (builder.match(data) if callable(builder.match) else builder.match == data):
+                    continue
+                if not accepts(builder, event):
+                    continue
+                calls.append((handler, event))
+
+        for handler, event in calls:
+            start: float = time.perf_counter()
+            try:
+                await handler(event)
+            except Exception:
+                self.errors += 1
+                logger.exception(f"Got exception from {handler.__name__}")
+            self.latencies[handler.__name__].append(time.perf_counter() - start)
+
+        self.latencies['update'].append(time.perf_counter() - scheduled)
+
+    async def run(self, entries: List[dict], speed: Optional[float]):
+        if not entries:
+            return
+
+        if speed is None:
+            for entry in entries:
+                await self.dispatch(entry, time.perf_counter())
+            return
+
+        tasks: List[asyncio.Task] = []
+        start: float = time.perf_counter()
+        first: float = entries[0]['ts']
+        for entry in entries:
+            scheduled: float = start + (entry['ts'] - first) / speed
+            delay: float = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.dispatch(entry, scheduled)))
+        await asyncio.gather(*tasks)
+
+    def report(self, elapsed: float, count: int):
+        print(f"Replayed {count} updates in {elapsed:.1f}s ({self.skipped} skipped, {self.errors} errors, {sum(self.stub.rpcs.values())} calls to telegram)")
+        print(f"{'':<28} {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for name in sorted(self.latencies, key=lambda name: (name != 'update', name)):
+            values: List[float] = sorted(self.latencies[name])
+            print(f"{name:<28} {len(values):>7} " + ' '.join(f"{percentile(values, p) * 1000:>7.1f}ms" for p in (0.5, 0.9, 0.99, 1)))
+
+async def main(args: argparse.Namespace):
+    entries: List[dict] = load(args.log)
+    handler_modules, message_handlers, callback_handlers, tortoise_models = discover()
+
+    stub = StubClient(latency=args.rpc_latency / 1000)
+    for mod in handler_modules:
+        if hasattr(mod, 'client'):
+            mod.client = stub
+
+    await Tortoise.init(db_url=args.db, modules={'models': tortoise_models}, use_tz=True)
+    try:
+        await Tortoise.generate_schemas()
+        # whatever's in --db, if anything. chats that got added at runtime don't have to be in there though:
+        # only chats we ran polls in got recorded, so every one of them counts
+        await ChatPollConfig.reload()
+        chatconfig.chats.update(entry['chat'] for entry in entries)
+
+        replayer = Replayer(stub, message_handlers, callback_handlers)
+        replayer.add_users(entries)
+
+        start: float = time.perf_counter()
+        await replayer.run(entries, None if args.max else args.speed)
+        replayer.report(time.perf_counter() - start, len(entries))
+    finally:
+        await Tortoise.close_connections()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m bot.replay')
+    parser.add_argument('log', nargs='+', help="recorded update log(s), .jsonl or .jsonl.gz")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--speed', type=float, default=1, help="replay N times as fast as recorded (default: 1)")
+    group.add_argument('--max', action='store_true', help="replay back to back, as fast as possible")
+    parser.add_argument('--rpc-latency', type=float, default=0, help="milliseconds every call to telegram takes")
+    parser.add_argument('--db', default='sqlite://:memory:', help="database to replay against (default: a fresh in-memory sqlite database)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    warnings.filterwarnings('ignore', message='.*received a naive datetime', category=RuntimeWarning) # TelegramUser/TelegramChat use utcnow()
+    asyncio.run(main(args))
@@ -0,0 +1,145 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+from datetime import datetime
+from hashlib import blake2b
+from typing import List, Optional
+
+import cachetools
+from telethon import events
+from telethon.events.newmessage import NewMessage
+from telethon.tl.types import MessageEntityMention, MessageEntityMentionName, PeerUser
+
+from bot.poll.models import Poll
+from config import REPLAY__RECORD_PATH, REPLAY__KEY
+
+logger = logging.getLogger(__name__)
+
+# incoming updates in the chats we run polls in (see bot.poll.chatconfig), written out by bot.replay.tasks.task_recorder as gzipped json lines
+# (see bot.replay.__main__ for the replaying part). user and chat ids, usernames, and every word of every
+# message go through a keyed hash, so the log says who did what and what repeats, but not who or what.
+# message ids are kept as they are, so that replies still point at the right message.
+#
+# message:  {"ts", "type": "message", "chat", "user", "msg", "reply_to", "text", "mentions": [user id or "@username", ...]}
+# callback: {"ts", "type": "callback", "chat", "user", "msg", "target", "choice"}
+
+_key: bytes = (REPLAY__KEY or os.urandom(16).hex()).encode('utf-8')
+
+# buffered entries, appended to on the event loop and written out in bulk
+buffer: List[dict] = []
+
+# poll_id -> target user id; a callback only tells us which poll it's for, the replayer needs to know who it's against
+poll_targets = cachetools.TTLCache(maxsize=1024, ttl=60*60)
+
+regex_url = re.compile(r'(?:https?://|www\.|\bt\.me/)\S+', re.I)
+regex_token = re.compile(fr'{regex_url.pattern}|@\w+|\w+', re.I)
+
+def _hash(value: str) -> int:
+    return int.from_bytes(blake2b(value.encode('utf-8'), digest_size=4, key=_key).digest(), 'big')
+
+def anonymize_user(user_id: int) -> int:
+    return _hash(f"user {user_id}") & 0x7fffffff or 1
+
+def anonymize_chat(chat_id: int) -> int:
+    return -1000000000000 - _hash(f"chat {chat_id}")
+
+def anonymize_username(username: str) -> str:
+    return f"@u{_hash(username.lstrip('@').lower()):08x}"
+
+def anonymize_text(text: str) -> str:
+    # keep the command itself, so that replays still hit the right handler
+    command: str = ''
+    if text.startswith('/'):
+        command, _, text = text.partition(' ')
+        command += _
+
+    def replace(match: re.Match) -> str:
+        token: str = match.group(0)
+        if token.startswith('@'):
+            return anonymize_username(token)
+        if regex_url.fullmatch(token):
+            return f"https://{_hash(token.lower()):08x}.example/"
+        return f"w{_hash(token.lower()):08x}"
+
+    return command + regex_token.sub(replace, text)
+
+def record_message(event: NewMessage.Event):
+    msg = event.message
+    if not isinstance(msg.from_id, PeerUser):
+        return
+
+    mentions: List[object] = []
+    for ent, txt in msg.get_entities_text():
+        if isinstance(ent, MessageEntityMentionName):
+            mentions.append(anonymize_user(ent.user_id))
+        elif isinstance(ent, MessageEntityMention):
+            mentions.append(anonymize_username(txt))
+
+    buffer.append({
+        'ts': round(time.time(), 3),
+        'type': 'message',
+        'chat': anonymize_chat(event.chat_id),
+        'user': anonymize_user(msg.from_id.user_id),
+        'msg': msg.id,
+        'reply_to': msg.reply_to.reply_to_msg_id if msg.reply_to else None,
+        'text': anonymize_text(msg.message or ''),
+        'mentions': mentions,
+    })
+
+def record_callback(event: events.CallbackQuery.Event, poll_id: str, choice: str):
+    buffer.append({
+        'ts': round(time.time(), 3),
+        'type': 'callback',
+        'chat': anonymize_chat(event.chat_id),
+        'user': anonymize_user(event.sender_id),
+        'msg': event.message_id,
+        'poll_id': poll_id, # swapped for the target in flush
+        'choice': choice,
+    })
+
+def _write(path: str, lines: List[str]):
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        f.writelines(lines)
+
+"""
+writes out everything recorded so far
+
+Returns:
+number of entries written
+"""
+async def flush() -> int:
+    if not buffer:
+        return 0
+
+    entries: List[dict] = buffer[:]
+    buffer.clear()
+
+    try:
+        # one query for all the polls we haven't seen yet
+        unknown = {uuid.UUID(entry['poll_id']) for entry in entries if entry['type'] == 'callback' and entry['poll_id'] not in poll_targets}
+        if unknown:
+            for poll_id, target_id in await Poll.filter(poll_id__in=unknown).values_list('poll_id', 'target_id'):
+                poll_targets[str(poll_id)] = target_id
+
+        lines: List[str] = []
+        for entry in entries:
+            if entry['type'] == 'callback':
+                entry = dict(entry)
+                target_id: Optional[int] = poll_targets.get(entry.pop('poll_id'))
+                entry['target'] = anonymize_user(target_id) if target_id is not None else None
+            lines.append(json.dumps(entry, separators=(',', ':')) + '\n')
+
+        path: str = datetime.now().strftime(REPLAY__RECORD_PATH)
+        await asyncio.to_thread(_write, path, lines)
+    except Exception:
+        # try again next time
+        buffer[:0] = entries
+        raise
+
+    return len(lines)
@@ -0,0 +1,24 @@
+import asyncio
+import logging
+
+from bot.replay import recorder
+from config import REPLAY__RECORD_PATH, REPLAY__FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+async def task_recorder():
+    if not REPLAY__RECORD_PATH:
+        return
+
+    logger.info(f"Recording updates to {REPLAY__RECORD_PATH}")
+    try:
+        while True:
+            await asyncio.sleep(REPLAY__FLUSH_INTERVAL.total_seconds())
+            try:
+                await recorder.flush()
+            except Exception:
+                logger.exception("Got exception while writing out recorded updates")
+    except asyncio.CancelledError:
+        # we're shutting down, so write out whatever we've got
+        await recorder.flush()
+        raise
@@ -0,0 +1,26 @@
+import logging
+import re
+
+from telethon import events
+from telethon.events.newmessage import NewMessage
+
+from bot.poll import chatconfig
+from bot.replay import recorder
+from config import REPLAY__RECORD_PATH
+
+logger = logging.getLogger(__name__)
+
+# these only ever append to a list, so that recording doesn't slow down the handlers that actually do something
+
+@events.register(events.NewMessage(incoming=True, func=chatconfig.in_chats))
+async def handler_record_message(event: NewMessage):
+    await chatconfig.loaded.wait() # see chatconfig.in_chats
+    if REPLAY__RECORD_PATH and chatconfig.in_chats(event):
+        recorder.record_message(event)
+
+regex_vote = re.compile(rb'^poll_vote (?P<poll_id>[a-f0-9-]{36}) (?P<choice>[a-z_]+)$', re.I)
+@events.register(events.CallbackQuery(data=regex_vote, func=chatconfig.in_chats))
+async def handler_record_callback(event: events.CallbackQuery.Event):
+    await chatconfig.loaded.wait()
+    if REPLAY__RECORD_PATH and chatconfig.in_chats(event):
+        recorder.record_callback(event, event.data_match.group('poll_id').decode('ascii').lower(), event.data_match.group('choice').decode('ascii').lower())
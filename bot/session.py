@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import pytz
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from telethon import utils
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession, SQLiteSession
+from telethon.tl import types
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+from tortoise.transactions import in_transaction
+
+from bot.models import TelegramSession, TelegramSessionEntity, TelegramUpdateState
+
+logger = logging.getLogger(__name__)
+
+# (marked id, access hash, username, phone, name), same as telethon's own sessions
+EntityRow = Tuple[int, int, Optional[str], Optional[str], Optional[str]]
+
+# everything that goes to or comes from a store
+class SessionData:
+    __slots__ = ('dc_id', 'server_address', 'port', 'auth_key', 'takeout_id', 'entities', 'update_states')
+
+    def __init__(self, dc_id: int = 0, server_address: Optional[str] = None, port: Optional[int] = None, auth_key: Optional[bytes] = None, takeout_id: Optional[int] = None):
+        self.dc_id = dc_id
+        self.server_address = server_address
+        self.port = port
+        self.auth_key = auth_key
+        self.takeout_id = takeout_id
+        self.entities: List[EntityRow] = []
+        self.update_states: List[Tuple[int, types.updates.State]] = []
+
+# reads and writes telethon's usual `<name>.session` sqlite file, so existing sessions keep working.
+# all of it happens on a worker thread, off the event loop
+class FileStore:
+    def __init__(self, name: str):
+        self.name = name
+
+    def _load(self, max_entities: int) -> SessionData:
+        sqlite = SQLiteSession(self.name) # creates the file, or upgrades an old one
+        try:
+            data = SessionData(sqlite.dc_id, sqlite.server_address, sqlite.port, sqlite.auth_key.key if sqlite.auth_key else None, sqlite.takeout_id)
+            c = sqlite._cursor()
+            try:
+                # most recently seen first, so that those are the ones that survive if there's too many
+                data.entities = c.execute('select id, hash, username, phone, name from entities order by date desc limit ?', (max_entities,)).fetchall()
+            finally:
+                c.close()
+            data.update_states = list(sqlite.get_update_states())
+            return data
+        finally:
+            sqlite.close()
+
+    def _save(self, data: SessionData):
+        sqlite = SQLiteSession(self.name)
+        try:
+            if data.server_address is not None:
+                sqlite.set_dc(data.dc_id, data.server_address, data.port)
+            sqlite.auth_key = AuthKey(data.auth_key) if data.auth_key else None
+            sqlite.takeout_id = data.takeout_id
+            for entity_id, state in data.update_states:
+                sqlite.set_update_state(entity_id, state)
+
+            c = sqlite._cursor()
+            try:
+                now = int(time.time())
+                c.executemany('insert or replace into entities values (?,?,?,?,?,?)', [(*row, now) for row in data.entities])
+            finally:
+                c.close()
+            sqlite.save()
+        finally:
+            sqlite.close()
+
+    async def load(self, max_entities: int) -> SessionData:
+        return await asyncio.to_thread(self._load, max_entities)
+
+    async def save(self, data: SessionData):
+        await asyncio.to_thread(self._save, data)
+
+# keeps the session in our own database (see bot.models), so that there's no separate file to look after.
+# only usable once Tortoise is up
+class DatabaseStore:
+    def __init__(self, name: str):
+        self.name = name
+
+    async def load(self, max_entities: int) -> SessionData:
+        row: Optional[TelegramSession] = await TelegramSession.get_or_none(name=self.name)
+        if row is None:
+            return SessionData()
+
+        data = SessionData(row.dc_id, row.server_address, row.port, row.auth_key, row.takeout_id)
+        data.entities = await TelegramSessionEntity.filter(session_id=self.name).order_by('-date').limit(max_entities).values_list('entity_id', 'hash', 'username', 'phone', 'name')
+        data.update_states = [
+            (state.entity_id, types.updates.State(pts=state.pts, qts=state.qts, date=state.date, seq=state.seq, unread_count=0))
+            async for state in TelegramUpdateState.filter(session_id=self.name)
+        ]
+        return data
+
+    async def save(self, data: SessionData):
+        now: datetime = datetime.now(tz=pytz.utc)
+        async with in_transaction():
+            await TelegramSession.update_or_create(name=self.name, defaults={
+                'dc_id': data.dc_id,
+                'server_address': data.server_address,
+                'port': data.port,
+                'auth_key': data.auth_key,
+                'takeout_id': data.takeout_id,
+            })
+
+            if data.entities:
+                ids: List[int] = [row[0] for row in data.entities]
+                await TelegramSessionEntity.filter(session_id=self.name, entity_id__in=ids).delete()
+                await TelegramSessionEntity.bulk_create([
+                    TelegramSessionEntity(session_id=self.name, entity_id=entity_id, hash=entity_hash, username=username, phone=phone, name=name, date=now)
+                    for entity_id, entity_hash, username, phone, name in data.entities
+                ])
+
+            if data.update_states:
+                await TelegramUpdateState.filter(session_id=self.name, entity_id__in=[entity_id for entity_id, _ in data.update_states]).delete()
+                await TelegramUpdateState.bulk_create([
+                    TelegramUpdateState(session_id=self.name, entity_id=entity_id, pts=state.pts, qts=state.qts, date=state.date, seq=state.seq)
+                    for entity_id, state in data.update_states
+                ])
+
+"""
+A telethon session that lives in memory, and gets written out to `store` every so often (see flush)
+instead of on every single update like the default SQLiteSession does.
+
+The entity cache (what get_input_entity looks things up in) is an LRU of at most `max_entities` entries,
+with lookups by id, username, phone and name all being dict lookups. Entities that fall out of it
+are still in the store, but have to be fetched from telegram again if they're needed.
+
+Arguments:
+store: a FileStore or a DatabaseStore
+max_entities: how many entities to keep in memory
+"""
+class CachedSession(MemorySession):
+    def __init__(self, store, max_entities: int):
+        super().__init__()
+        self.store = store
+        self.max_entities = max_entities
+
+        self._rows: OrderedDict[int, EntityRow] = OrderedDict() # least recently used first
+        self._usernames: Dict[str, int] = dict()
+        self._phones: Dict[str, int] = dict()
+        self._names: Dict[str, int] = dict()
+
+        # what's changed since the last flush
+        self._dirty: bool = False
+        self._dirty_entities: Dict[int, EntityRow] = dict()
+        self._dirty_states: Set[int] = set()
+        self._flush_lock = asyncio.Lock()
+
+        # set once we've handed over to another process (see freeze_update_states)
+        self._states_frozen: bool = False
+
+    async def load(self):
+        data: SessionData = await self.store.load(self.max_entities)
+        if data.server_address is not None:
+            super().set_dc(data.dc_id, data.server_address, data.port)
+        self._auth_key = AuthKey(data.auth_key) if data.auth_key else None
+        self._takeout_id = data.takeout_id
+        self._update_states = dict(data.update_states)
+
+        # oldest first, so that they end up least recently used
+        for row in reversed(data.entities):
+            self._add_row(tuple(row))
+
+        logger.info(f"Loaded session with {len(self._rows)} entities and {len(self._update_states)} update states")
+
+    """
+    writes out whatever's changed since the last flush
+
+    Returns:
+    number of entities written
+    """
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not (self._dirty or self._dirty_entities or self._dirty_states):
+                return 0
+
+            data = SessionData(self._dc_id, self._server_address, self._port, self._auth_key.key if self._auth_key else None, self._takeout_id)
+            data.entities = list(self._dirty_entities.values())
+            data.update_states = [(entity_id, self._update_states[entity_id]) for entity_id in self._dirty_states if entity_id in self._update_states]
+
+            dirty, dirty_entities, dirty_states = self._dirty, self._dirty_entities, self._dirty_states
+            self._dirty, self._dirty_entities, self._dirty_states = False, dict(), set()
+
+            try:
+                await self.store.save(data)
+            except Exception:
+                # put it all back for next time, unless there's something newer already
+                self._dirty = self._dirty or dirty
+                self._dirty_entities = {**dirty_entities, **self._dirty_entities}
+                self._dirty_states |= dirty_states
+                raise
+
+            logger.debug(f"Flushed session with {len(data.entities)} entities and {len(data.update_states)} update states")
+            return len(data.entities)
+
+    async def flush_every(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Got exception while flushing session")
+
+    # telethon calls these whenever anything changes; all we do is remember that it did
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._dirty = True
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._dirty = True
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._dirty = True
+
+    def set_update_state(self, entity_id, state):
+        if self._states_frozen:
+            return
+        super().set_update_state(entity_id, state)
+        self._dirty_states.add(entity_id)
+
+    def save(self):
+        pass
+
+    # from here on, the update state stays as it is now, no matter what telethon says.
+    # whoever takes over from us picks up from there, so anything we don't handle after this isn't lost
+    def freeze_update_states(self):
+        self._states_frozen = True
+
+    # telethon calls this on disconnect without awaiting it, so there's nothing to do here; see tg_stop for the last flush
+    def close(self):
+        pass
+
+    def _add_row(self, row: EntityRow):
+        entity_id, _, username, phone, name = row
+        old: Optional[EntityRow] = self._rows.get(entity_id)
+        if old is not None:
+            self._unindex(old)
+
+        self._rows[entity_id] = row
+        self._rows.move_to_end(entity_id)
+        if username:
+            self._usernames[username] = entity_id
+        if phone:
+            self._phones[phone] = entity_id
+        if name:
+            self._names[name] = entity_id
+
+        while len(self._rows) > self.max_entities:
+            _, evicted = self._rows.popitem(last=False)
+            self._unindex(evicted)
+
+    def _unindex(self, row: EntityRow):
+        entity_id, _, username, phone, name = row
+        for index, key in ((self._usernames, username), (self._phones, phone), (self._names, name)):
+            if key and index.get(key) == entity_id:
+                del index[key]
+
+    def _get(self, entity_id: Optional[int]) -> Optional[Tuple[int, int]]:
+        row: Optional[EntityRow] = self._rows.get(entity_id)
+        if row is None:
+            return None
+        self._rows.move_to_end(entity_id)
+        return row[0], row[1]
+
+    def process_entities(self, tlo):
+        for row in self._entities_to_rows(tlo):
+            if self._rows.get(row[0]) == row:
+                # nothing new, which is most of the time
+                self._rows.move_to_end(row[0])
+                continue
+            self._add_row(row)
+            self._dirty_entities[row[0]] = row
+
+    def get_entity_rows_by_phone(self, phone):
+        return self._get(self._phones.get(phone))
+
+    def get_entity_rows_by_username(self, username):
+        return self._get(self._usernames.get(username))
+
+    def get_entity_rows_by_name(self, name):
+        return self._get(self._names.get(name))
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            return self._get(id)
+
+        for peer_id in (utils.get_peer_id(PeerUser(id)), utils.get_peer_id(PeerChat(id)), utils.get_peer_id(PeerChannel(id))):
+            result = self._get(peer_id)
+            if result:
+                return result
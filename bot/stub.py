@@ -0,0 +1,207 @@
+"""
+A stand-in for bot.telegram.client, plus fake NewMessage/CallbackQuery events to feed the handlers with,
+for running them without talking to telegram (see bot.budget and bot.replay).
+
+Only covers what the handlers actually use. Every call that would be a round-trip to telegram
+gets counted in StubClient.rpcs, and takes StubClient.latency seconds.
+"""
+import asyncio
+import itertools
+import logging
+
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import pytz
+from telethon import utils
+from telethon.errors.rpcerrorlist import UserNotParticipantError
+from telethon.tl import types
+from telethon.tl.functions.channels import GetParticipantRequest
+from telethon.tl.types import Channel, ChatPhotoEmpty, InputPeerChannel, InputPeerUser, PeerChannel, PeerUser, User
+
+logger = logging.getLogger(__name__)
+
+class StubMessage:
+    def __init__(self, client: 'StubClient', chat_id: int, msg_id: int, text: str = '', sender_id: Optional[int] = None, reply_to: Optional['StubMessage'] = None, entities: Optional[List[Tuple[types.TypeMessageEntity, str]]] = None):
+        self.client = client
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.message = text
+        self.sender_id = sender_id
+        self.from_id = PeerUser(sender_id) if sender_id is not None else None
+        self.to_id = PeerChannel(utils.resolve_id(chat_id)[0])
+        self.chat = client.chats.get(chat_id)
+        self.date = datetime.now(tz=pytz.utc)
+        self.reply_to = reply_to
+        self.is_reply = reply_to is not None
+        self.buttons = None
+        self.entities = entities or []
+
+    @property
+    def text(self) -> str:
+        return self.message
+
+    def get_entities_text(self) -> List[Tuple[types.TypeMessageEntity, str]]:
+        return self.entities
+
+    async def get_reply_message(self) -> Optional['StubMessage']:
+        await self.client.rpc('get_reply_message')
+        return self.reply_to
+
+    async def reply(self, message: str, buttons=None, **kwargs) -> 'StubMessage':
+        return await self.client.send(self.chat_id, message, buttons, reply_to=self)
+
+    async def edit(self, message: str, buttons=None):
+        await self.client.rpc('edit_message')
+        self.message = message
+        self.buttons = buttons
+        return self
+
+    async def delete(self):
+        await self.client.rpc('delete_messages')
+        self.client.messages.pop((self.chat_id, self.id), None)
+
+class StubClient:
+    def __init__(self, chat_ids: Iterable[int] = (), admins: Iterable[int] = (), non_members: Iterable[int] = (), latency: float = 0):
+        self.rpcs: Counter = Counter()
+        self.latency = latency
+        self.chats: Dict[int, Channel] = dict()
+        self.users: Dict[int, User] = dict()
+        self.admins: Set[int] = set(admins)
+        self.non_members: Set[int] = set(non_members)
+        self.messages: Dict[Tuple[int, int], StubMessage] = dict()
+        self._msg_ids = itertools.count(1000)
+        for chat_id in chat_ids:
+            self.add_chat(chat_id)
+
+    def add_chat(self, chat_id: int) -> Channel:
+        chat = self.chats[chat_id] = Channel(id=utils.resolve_id(chat_id)[0], title=f"chat {chat_id}", photo=ChatPhotoEmpty(), date=None, access_hash=0)
+        return chat
+
+    async def rpc(self, name: str):
+        self.rpcs[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def add_user(self, user_id: int, username: Optional[str] = None) -> User:
+        user = self.users[user_id] = User(id=user_id, access_hash=0, first_name=f"user {user_id}", username=username)
+        return user
+
+    # a message that's already in the chat, i.e. not one we're sending
+    def message(self, chat_id: int, sender_id: Optional[int], text: str, reply_to: Optional[StubMessage] = None, msg_id: Optional[int] = None, entities: Optional[List[Tuple[types.TypeMessageEntity, str]]] = None) -> StubMessage:
+        msg = StubMessage(self, chat_id, msg_id if msg_id is not None else next(self._msg_ids), text, sender_id, reply_to, entities)
+        self.messages[(chat_id, msg.id)] = msg
+        return msg
+
+    async def send(self, chat_id: int, message: str, buttons=None, reply_to: Optional[StubMessage] = None) -> StubMessage:
+        await self.rpc('send_message')
+        msg = self.message(chat_id, None, message, reply_to)
+        msg.buttons = buttons
+        return msg
+
+    async def __call__(self, request):
+        await self.rpc(type(request).__name__)
+        if isinstance(request, GetParticipantRequest):
+            user_id: int = getattr(request.participant, 'user_id', None)
+            if user_id in self.non_members:
+                raise UserNotParticipantError(request)
+            if user_id in self.admins:
+                participant = types.ChannelParticipantCreator(user_id=user_id, admin_rights=types.ChatAdminRights())
+            else:
+                participant = types.ChannelParticipant(user_id=user_id, date=datetime.now(tz=pytz.utc))
+            return types.channels.ChannelParticipant(participant=participant, chats=[], users=[])
+        raise NotImplementedError(f"StubClient doesn't know what to do with a {type(request).__name__}")
+
+    def _resolve(self, key):
+        if isinstance(key, str):
+            key = key.lstrip('@').lower()
+            for user in self.users.values():
+                if user.username and user.username.lower() == key:
+                    return user
+            raise ValueError(f"No user has the username {key}")
+
+        peer_id: int = key if isinstance(key, int) else utils.get_peer_id(key)
+        if peer_id in self.chats:
+            return self.chats[peer_id]
+        if peer_id in self.users:
+            return self.users[peer_id]
+        raise ValueError(f"Could not find the input entity for {key}")
+
+    # comes out of the session cache for anything we've seen before, so it doesn't count as a round-trip
+    async def get_input_entity(self, key):
+        entity = self._resolve(key)
+        if isinstance(entity, Channel):
+            return InputPeerChannel(entity.id, entity.access_hash)
+        return InputPeerUser(entity.id, entity.access_hash)
+
+    async def get_entity(self, key):
+        await self.rpc('get_entity')
+        if isinstance(key, InputPeerChannel):
+            key = utils.get_peer_id(PeerChannel(key.channel_id))
+        elif isinstance(key, InputPeerUser):
+            key = key.user_id
+        return self._resolve(key)
+
+    async def iter_messages(self, entity, ids: int):
+        await self.rpc('get_messages')
+        chat_id: int = utils.get_peer_id(entity)
+        msg: Optional[StubMessage] = self.messages.get((chat_id, ids))
+        if msg is not None:
+            yield msg
+
+    async def edit_message(self, entity, message: int, text: str, buttons=None):
+        await self.rpc('edit_message')
+        msg: Optional[StubMessage] = self.messages.get((entity, message))
+        if msg is not None:
+            msg.message = text
+            msg.buttons = buttons
+        return msg
+
+    async def edit_permissions(self, entity, user, **kwargs):
+        await self.rpc('edit_permissions')
+
+    async def send_message(self, entity, message: str, buttons=None, **kwargs) -> StubMessage:
+        return await self.send(entity, message, buttons)
+
+# what handler_bob and friends get from telethon's events.NewMessage
+class StubNewMessage:
+    def __init__(self, client: StubClient, message: StubMessage, pattern: Optional[Callable] = None):
+        self.client = client
+        self.message = message
+        self.chat_id = message.chat_id
+        self.to_id = message.to_id
+        self.from_id = message.from_id
+        self.sender_id = message.sender_id
+        self.is_reply = message.is_reply
+        self.pattern_match = pattern(message.message) if pattern is not None else None
+
+    def get_entities_text(self):
+        return self.message.get_entities_text()
+
+    async def get_reply_message(self) -> Optional[StubMessage]:
+        return await self.message.get_reply_message()
+
+    async def reply(self, message: str, buttons=None, **kwargs) -> StubMessage:
+        return await self.message.reply(message, buttons)
+
+# what handler_bob_callback gets from telethon's events.CallbackQuery
+class StubCallbackQuery:
+    def __init__(self, client: StubClient, message: StubMessage, sender_id: int, data: bytes):
+        self.client = client
+        self._message = message
+        self.chat_id = message.chat_id
+        self.sender_id = sender_id
+        self.data = data
+        self.answers: List[Tuple[tuple, dict]] = []
+
+    async def get_message(self) -> StubMessage:
+        await self.client.rpc('get_messages')
+        return self._message
+
+    async def get_input_sender(self) -> InputPeerUser:
+        return InputPeerUser(self.sender_id, 0)
+
+    async def answer(self, *args, **kwargs):
+        await self.client.rpc('answer_callback_query')
+        self.answers.append((args, kwargs))
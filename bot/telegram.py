@@ -1,18 +1,241 @@
+import asyncio
+import fcntl
+import inspect
+import logging
+import os
+import signal
+
+from datetime import datetime
+from time import monotonic
+from typing import Awaitable, Callable, List, Optional, Set, TextIO, Tuple
+
+import pytz
 from telethon import TelegramClient, events
-from config import TG_SESSION, TG_API_ID, TG_API_HASH, TG_API_TOKEN
+from config import TG_SESSION, TG_API_ID, TG_API_HASH, TG_API_TOKEN, TG_CATCHUP_QUIET, TG_CATCHUP_MAX_DURATION, TG_CATCHUP_STALE_AFTER
+from config import TG_SESSION_BACKEND, TG_SESSION_MAX_ENTITIES, TG_SESSION_FLUSH_INTERVAL, TG_PIDFILE, TG_HANDOFF_TIMEOUT
+
+from .session import CachedSession, DatabaseStore, FileStore
+
+logger = logging.getLogger(__name__)
+
+# after a reconnect, telegram hands us everything we missed in one go.
+# while that backlog is coming in, handlers can buffer updates here instead of handling them
+# one by one, and handle them in bulk (through the functions registered with on_drain) once it dries up
+class CatchUp:
+    def __init__(self, quiet: float, max_duration: float, stale_after: float):
+        self.quiet = quiet
+        self.max_duration = max_duration
+        self.stale_after = stale_after
+        self.active: bool = False
+        self.draining: bool = False # the backlog has dried up, so anything that comes in now is live
+        self._drains: List[Callable[[], Awaitable[int]]] = []
+        self._started: float = 0
+        self._last_update: float = 0
+        self._task: Optional[asyncio.Task] = None
+
+    """
+    registers a coroutine function that handles everything buffered so far, and returns how many things it handled
+    """
+    def on_drain(self, func: Callable[[], Awaitable[int]]) -> Callable[[], Awaitable[int]]:
+        self._drains.append(func)
+        return func
+
+    def begin(self):
+        if self.active:
+            return
+
+        logger.info("Catching up on missed updates")
+        self.active = True
+        self._started = self._last_update = monotonic()
+        self._task = asyncio.ensure_future(self._run())
+
+    # call whenever something gets buffered
+    def touch(self):
+        self._last_update = monotonic()
+
+    # the backlog that's still being handled, if there is one
+    @property
+    def running(self) -> Optional[asyncio.Task]:
+        return self._task if self.active else None
+
+    def is_stale(self, date: Optional[datetime]) -> bool:
+        return date is not None and (datetime.now(tz=pytz.utc) - date).total_seconds() > self.stale_after
+
+    async def _run(self):
+        try:
+            # wait for the backlog to dry up
+            while monotonic() - self._last_update < self.quiet and monotonic() - self._started < self.max_duration:
+                await asyncio.sleep(self.quiet)
+
+            # anything that comes in while we're draining still gets buffered,
+            # so keep going until there's nothing left
+            self.draining = True
+            handled: int = 1
+            while handled:
+                handled = 0
+                for drain in self._drains:
+                    try:
+                        handled += await drain()
+                    except Exception:
+                        logger.exception(f"Got exception while draining {drain.__name__}")
+        finally:
+            self.active = self.draining = False
+            logger.info(f"Caught up in {monotonic() - self._started:.1f}s")
+
+catchup = CatchUp(TG_CATCHUP_QUIET.total_seconds(), TG_CATCHUP_MAX_DURATION.total_seconds(), TG_CATCHUP_STALE_AFTER.total_seconds())
+
+class Client(TelegramClient):
+    # see stop_accepting
+    draining: bool = False
+    accepted: Set[asyncio.Task] = set()
+
+    # telethon calls this once it has reconnected; there's no public hook for it
+    async def _handle_auto_reconnect(self):
+        catchup.begin()
+        await super()._handle_auto_reconnect()
+
+    # telethon runs this in a task of its own for every update
+    async def _dispatch_update(self, update):
+        if self.draining and asyncio.current_task() not in self.accepted:
+            return # left for whoever takes over from us
+        await super()._dispatch_update(update)
 
-client = TelegramClient(
-    TG_SESSION,
+    """
+    stops handling updates, other than those we've already started on
+
+    The update state gets saved as of right now, and stays that way (see CachedSession.freeze_update_states),
+    so the next process asks telegram for everything after that when it starts up. Nothing awaits in here,
+    so no update can slip in between the state we save and the updates we keep handling.
+
+    Returns:
+    the tasks handling the updates we're still on
+    """
+    async def stop_accepting(self) -> Set[asyncio.Task]:
+        self.accepted = set(self._event_handler_tasks)
+        saved = self._save_states_and_entities() # plain function up to telethon 1.36, a coroutine in later versions
+        if inspect.isawaitable(saved):
+            await saved
+        self.session.freeze_update_states()
+        self.draining = True
+        return self.accepted
+
+    async def load_session(self):
+        await self.session.load()
+        # the sender got its auth key from the session back when the client was created, before the session had anything in it
+        self._sender.auth_key.key = self.session.auth_key.key if self.session.auth_key else None
+
+session = CachedSession(DatabaseStore(TG_SESSION) if TG_SESSION_BACKEND == 'database' else FileStore(TG_SESSION), TG_SESSION_MAX_ENTITIES)
+session_flush: Optional[asyncio.Task] = None
+
+client = Client(
+    session,
     TG_API_ID,
     TG_API_HASH,
     connection_retries=None,
     retry_delay=10,
     auto_reconnect=True,
+    catch_up=True, # pick up where the last process left off, see tg_release
 )
 client.parse_mode = 'html'
 
+# TG_PIDFILE, locked for as long as we're the one handling updates
+pidfile: Optional[TextIO] = None
+
+"""
+waits for whoever's handling updates at the moment (if anyone) to hand over to us, asking it to with a SIGTERM
+
+We only connect once it has, since it saves the update state we start from on the way out (see tg_release). Updates
+don't get lost in between, but the ones that come in after the SIGTERM wait for that: up to TG_DRAIN_TIMEOUT for the
+old process to finish up, then however long it takes us to connect.
+
+Raises RuntimeError if it doesn't let go within TG_HANDOFF_TIMEOUT, since two of us handling the same updates is worse than none.
+"""
+async def tg_take_over():
+    global pidfile
+    f: TextIO = open(TG_PIDFILE, 'a+')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.seek(0)
+        pid: str = f.read().strip()
+        logger.info(f"Asking the running instance ({pid or 'unknown pid'}) to hand over")
+        try:
+            os.kill(int(pid), signal.SIGTERM)
+        except (ValueError, ProcessLookupError):
+            pass # still holding the lock, so it'll be gone soon enough
+
+        start: float = monotonic()
+        try:
+            while True:
+                await asyncio.sleep(0.1)
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if monotonic() - start > TG_HANDOFF_TIMEOUT.total_seconds():
+                        raise RuntimeError(f"The running instance ({pid or 'unknown pid'}) didn't hand over within {TG_HANDOFF_TIMEOUT}")
+        except BaseException: # including being cancelled, see bot.__main__.main
+            f.close()
+            raise
+        logger.info(f"Took over in {monotonic() - start:.1f}s")
+
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    pidfile = f
+
+"""
+lets go of TG_PIDFILE, if we've got it, so that another process can take over (see tg_take_over).
+that process picks up from the update state saved by Client.stop_accepting, and loads everything else
+from the database, so this should be the very last thing we do, once all of that has been written out
+"""
+def tg_release():
+    global pidfile
+    if pidfile is not None:
+        fcntl.flock(pidfile, fcntl.LOCK_UN)
+        pidfile.close()
+        pidfile = None
+
+"""
+waits up to `timeout` seconds for the updates we'd already started on (and the catch-up backlog, if
+we're in the middle of one) to be handled. whatever's left after that gets cut off by tg_stop
+
+Returns:
+number of tasks that finished, and number of tasks that didn't
+"""
+async def tg_drain(timeout: float) -> Tuple[int, int]:
+    waiting: Set[asyncio.Task] = {task for task in client.accepted if not task.done()}
+    if catchup.running is not None:
+        waiting.add(catchup.running)
+    if not waiting:
+        return 0, 0
+
+    done, pending = await asyncio.wait(waiting, timeout=timeout)
+    return len(done), len(pending)
+
 async def tg_start():
+    global session_flush
+    await client.load_session()
     await client.start(bot_token=TG_API_TOKEN)
+    session_flush = asyncio.ensure_future(session.flush_every(TG_SESSION_FLUSH_INTERVAL.total_seconds()))
+
+async def flush_session():
+    try:
+        await session.flush()
+    except Exception:
+        logger.exception("Got exception while flushing session")
 
 async def tg_stop():
+    if session_flush is None:
+        # we never got as far as handling updates, so there's nothing of ours worth writing out,
+        # and the update state telethon saves on disconnect would clobber the one that is
+        await client.disconnect()
+        return
+    session_flush.cancel()
+
+    # telethon doesn't await CachedSession.close, so the last flush is up to us: once before disconnecting in case
+    # that goes wrong, and once after, for the update state and entities telethon saves on the way out
+    await flush_session()
     await client.disconnect()
+    await flush_session() # nothing gets written if nothing changed
@@ -1,14 +1,46 @@
 import asyncio
+import logging
+
+from typing import Set
+
+logger = logging.getLogger(__name__)
 
 class Timer:
+    # every timer that hasn't gone off yet, so that they can all be fired early when we're shutting down
+    pending: Set['Timer'] = set()
+
     def __init__(self, timeout, callback):
         self._timeout = timeout
         self._callback = callback
         self._task = asyncio.ensure_future(self._job())
+        Timer.pending.add(self)
 
     async def _job(self):
         await asyncio.sleep(self._timeout)
+        Timer.pending.discard(self)
         await self._callback()
 
     def cancel(self):
         self._task.cancel()
+        Timer.pending.discard(self)
+
+    """
+    runs every pending timer's callback right away, instead of when it's due
+
+    Returns:
+    number of callbacks that ran without errors
+    """
+    @classmethod
+    async def fire_all(cls) -> int:
+        timers = list(cls.pending)
+        for timer in timers:
+            timer.cancel()
+
+        fired: int = 0
+        for timer in timers:
+            try:
+                await timer._callback()
+                fired += 1
+            except Exception:
+                logger.exception(f"Got exception while firing {timer._callback}")
+        return fired
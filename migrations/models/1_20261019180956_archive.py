@@ -0,0 +1,54 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "archivedpoll" (
+    "poll_id" CHAR(36) NOT NULL  PRIMARY KEY /* Unique poll id, same as the original Poll */,
+    "timestamp" TIMESTAMP NOT NULL  /* Time of poll */,
+    "poll_type" SMALLINT NOT NULL  DEFAULT 1 /* type of poll */,
+    "forced" INT NOT NULL  DEFAULT 0 /* was this poll forced, e.g. started by an admin? */,
+    "msg_id" INT   /* message ID that bob was called on */,
+    "poll_msg_id" INT   /* msg id of poll message */,
+    "outcome" SMALLINT   /* winning choice, or null if the poll ended without one */,
+    "archived_at" TIMESTAMP NOT NULL  DEFAULT CURRENT_TIMESTAMP /* Time of archival */,
+    "chat_id" INT NOT NULL REFERENCES "telegramchat" ("chat_id") ON DELETE RESTRICT /* chat in which the poll was started */,
+    "source_id" INT NOT NULL REFERENCES "telegramuser" ("user_id") ON DELETE RESTRICT /* user who initiated the poll */,
+    "target_id" INT NOT NULL REFERENCES "telegramuser" ("user_id") ON DELETE RESTRICT /* target of the poll */
+);
+        CREATE TABLE IF NOT EXISTS "archivedvote" (
+    "vote_id" CHAR(36) NOT NULL  PRIMARY KEY /* Unique vote id, same as the original Vote */,
+    "choice" SMALLINT NOT NULL  /* choice selected by user */,
+    "timestamp" TIMESTAMP NOT NULL  /* Time of first vote */,
+    "poll_id" CHAR(36) NOT NULL REFERENCES "archivedpoll" ("poll_id") ON DELETE RESTRICT,
+    "user_id" INT NOT NULL REFERENCES "telegramuser" ("user_id") ON DELETE RESTRICT /* user that cast this vote */,
+    CONSTRAINT "uid_archivedvot_poll_id_79af9d" UNIQUE ("poll_id", "user_id")
+);
+        CREATE TABLE IF NOT EXISTS "polldailystats" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "day" DATE NOT NULL  /* day (UTC) the polls were started on */,
+    "poll_type" SMALLINT NOT NULL  DEFAULT 1 /* type of poll */,
+    "polls" INT NOT NULL  DEFAULT 0 /* number of polls started */,
+    "banned" INT NOT NULL  DEFAULT 0 /* number of polls that ended with a yes */,
+    "cleared" INT NOT NULL  DEFAULT 0 /* number of polls that ended with a no */,
+    "unresolved" INT NOT NULL  DEFAULT 0 /* number of polls that ended without a winner */,
+    "chat_id" INT NOT NULL REFERENCES "telegramchat" ("chat_id") ON DELETE RESTRICT /* chat the polls were started in */,
+    CONSTRAINT "uid_polldailyst_chat_id_750a75" UNIQUE ("chat_id", "day", "poll_type")
+);
+        CREATE TABLE IF NOT EXISTS "voterstats" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "votes" INT NOT NULL  DEFAULT 0 /* total number of votes cast */,
+    "yes_votes" INT NOT NULL  DEFAULT 0 /* number of yes votes cast */,
+    "no_votes" INT NOT NULL  DEFAULT 0 /* number of no votes cast */,
+    "chat_id" INT NOT NULL REFERENCES "telegramchat" ("chat_id") ON DELETE RESTRICT /* chat the votes were cast in */,
+    "user_id" INT NOT NULL REFERENCES "telegramuser" ("user_id") ON DELETE RESTRICT /* user that cast the votes */,
+    CONSTRAINT "uid_voterstats_chat_id_b7f9c4" UNIQUE ("chat_id", "user_id")
+);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "archivedpoll";
+        DROP TABLE IF EXISTS "archivedvote";
+        DROP TABLE IF EXISTS "polldailystats";
+        DROP TABLE IF EXISTS "voterstats";"""
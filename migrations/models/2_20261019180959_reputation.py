@@ -0,0 +1,20 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "userreputation" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "initiated" INT NOT NULL  DEFAULT 0 /* number of polls started by this user */,
+    "succeeded" INT NOT NULL  DEFAULT 0 /* number of polls started by this user that ended with a yes */,
+    "failed" INT NOT NULL  DEFAULT 0 /* number of polls started by this user that ended with a no */,
+    "cleared_at" TIMESTAMP   /* last time a poll against this user ended with a no */,
+    "chat_id" INT NOT NULL REFERENCES "telegramchat" ("chat_id") ON DELETE RESTRICT /* chat this reputation applies to */,
+    "user_id" INT NOT NULL REFERENCES "telegramuser" ("user_id") ON DELETE RESTRICT /* user this reputation applies to */,
+    CONSTRAINT "uid_userreputat_chat_id_965ccc" UNIQUE ("chat_id", "user_id")
+);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "userreputation";"""
@@ -0,0 +1,26 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "banneduser" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "poll_id" CHAR(36)   /* poll that banned the user */,
+    "timestamp" TIMESTAMP NOT NULL  DEFAULT CURRENT_TIMESTAMP /* Time of ban */,
+    "chat_id" INT NOT NULL REFERENCES "telegramchat" ("chat_id") ON DELETE RESTRICT /* chat in which the user was first banned */,
+    "user_id" INT NOT NULL REFERENCES "telegramuser" ("user_id") ON DELETE RESTRICT /* banned user */
+);
+        CREATE TABLE IF NOT EXISTS "banpropagation" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "chat_id" INT NOT NULL  /* chat to apply the ban to */,
+    "status" SMALLINT NOT NULL  DEFAULT 1 /* has the ban been applied yet? */,
+    "timestamp" TIMESTAMP NOT NULL  DEFAULT CURRENT_TIMESTAMP /* Time of last status change */,
+    "ban_id" INT NOT NULL REFERENCES "banneduser" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_banpropagat_ban_id_08054c" UNIQUE ("ban_id", "chat_id")
+);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "banpropagation";
+        DROP TABLE IF EXISTS "banneduser";"""
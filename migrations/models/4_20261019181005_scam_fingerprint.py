@@ -0,0 +1,18 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "scamfingerprint" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "kind" SMALLINT NOT NULL  /* type of fingerprint */,
+    "value" BLOB NOT NULL  /* the fingerprint itself */,
+    "poll_id" CHAR(36)   /* poll that banned the sender */,
+    "timestamp" TIMESTAMP NOT NULL  DEFAULT CURRENT_TIMESTAMP /* Time of fingerprinting */,
+    "chat_id" INT NOT NULL REFERENCES "telegramchat" ("chat_id") ON DELETE RESTRICT /* chat the message was posted in */
+);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "scamfingerprint";"""
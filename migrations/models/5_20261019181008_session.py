@@ -0,0 +1,41 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "telegramsession" (
+    "name" VARCHAR(64) NOT NULL  PRIMARY KEY /* session name (TG_SESSION) */,
+    "dc_id" INT NOT NULL  DEFAULT 0 /* datacenter we're connected to */,
+    "server_address" VARCHAR(64)   /* address of that datacenter */,
+    "port" INT   /* port of that datacenter */,
+    "auth_key" BLOB   /* auth key for that datacenter */,
+    "takeout_id" BIGINT   /* takeout session id, if any */
+);
+        CREATE TABLE IF NOT EXISTS "telegramsessionentity" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "entity_id" BIGINT NOT NULL  /* marked peer id */,
+    "hash" BIGINT NOT NULL  /* access hash */,
+    "username" VARCHAR(64)   /* lowercased @username */,
+    "phone" VARCHAR(32)   /* phone number */,
+    "name" VARCHAR(256)   /* display name */,
+    "date" TIMESTAMP NOT NULL  /* when we last saw this entity change */,
+    "session_id" VARCHAR(64) NOT NULL REFERENCES "telegramsession" ("name") ON DELETE CASCADE,
+    CONSTRAINT "uid_telegramses_session_89cd2a" UNIQUE ("session_id", "entity_id")
+);
+        CREATE TABLE IF NOT EXISTS "telegramupdatestate" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "entity_id" BIGINT NOT NULL  /* 0 for the account itself, otherwise the channel's id */,
+    "pts" INT NOT NULL,
+    "qts" INT NOT NULL,
+    "date" TIMESTAMP NOT NULL,
+    "seq" INT NOT NULL,
+    "session_id" VARCHAR(64) NOT NULL REFERENCES "telegramsession" ("name") ON DELETE CASCADE,
+    CONSTRAINT "uid_telegramupd_session_f035e0" UNIQUE ("session_id", "entity_id")
+);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "telegramsession";
+        DROP TABLE IF EXISTS "telegramsessionentity";
+        DROP TABLE IF EXISTS "telegramupdatestate";"""
@@ -0,0 +1,18 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "chatpollconfig" (
+    "chat_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL /* chat these settings apply to */,
+    "enabled" INT NOT NULL  DEFAULT 1 /* do we run polls in this chat? */,
+    "threshold" INT   /* number of votes before we process an action */,
+    "limit" INT   /* maximum number of polls allowed in limit_duration */,
+    "limit_duration" BIGINT   /* see limit */,
+    "version" INT NOT NULL  DEFAULT 0 /* bumped on every change */
+);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "chatpollconfig";"""